@@ -0,0 +1,282 @@
+"""Офлайн-бенчмарк бота: рассылка (/notify и мастер), шторм колбэков и /report против фейкового Bot API.
+
+Запуск: python benchmarks/bot_suite.py --users 10000 --latency-ms 20 --rate-429 0.001 --output bench.json
+
+Бот импортируется в этом же процессе с временной БД; апдейты подаются через dp.feed_raw_update,
+все запросы к Telegram уходят в FakeBotAPI. Результат — один JSON для сравнения между прогонами.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fake_bot_api import FakeBotAPI, add_config_arguments, config_from_args
+
+ADMIN_ID = 1
+FIRST_USER_ID = 1_000_000
+CENTER = (55.75, 37.62)  # место сбора в сценарии мастера
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def latency_summary(latencies):
+    return {
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 2),
+    }
+
+
+def seed_database(conn, users, incidents, response_rate, seed):
+    """Синтетические пользователи, прошлые инциденты и отклики по ним."""
+    rnd = random.Random(seed)
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + users)
+    conn.execute("INSERT OR IGNORE INTO users (user_id, username, first_name, is_member) VALUES (?, 'admin', 'Admin', 1)", (ADMIN_ID,))
+    conn.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (ADMIN_ID,))
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, is_member) VALUES (?, ?, ?, 1)",
+        ((uid, f"user{uid}" if uid % 2 else None, f"Имя{uid}") for uid in user_ids)
+    )
+    for _ in range(incidents):
+        incident_id = conn.execute(
+            "INSERT INTO incidents (text, place, creator_id) VALUES ('Архивный инцидент', 'Площадь', ?)", (ADMIN_ID,)
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO responses (incident_id, user_id, status) VALUES (?, ?, ?)",
+            ((incident_id, uid, rnd.choice(("Пойду", "Не могу"))) for uid in user_ids if rnd.random() < response_rate)
+        )
+    conn.commit()
+
+
+def seed_locations(conn, users, share, geo_cell, seed):
+    """Геолокации доли share пользователей в квадрате примерно 45x40 км вокруг CENTER."""
+    rnd = random.Random(seed)
+    rows = []
+    for uid in range(FIRST_USER_ID, FIRST_USER_ID + users):
+        if rnd.random() < share:
+            lat, lon = CENTER[0] + rnd.uniform(-0.2, 0.2), CENTER[1] + rnd.uniform(-0.3, 0.3)
+            rows.append((uid, lat, lon, *geo_cell(lat, lon)))
+    conn.executemany("INSERT INTO user_locations (user_id, lat, lon, cell_lat, cell_lon) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    return len(rows)
+
+
+def admin_update(update_id, **fields):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": ADMIN_ID, "type": "private", "first_name": "Admin"},
+            "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin", "username": "admin"},
+            **fields,
+        },
+    }
+
+
+def command_update(update_id, text):
+    return admin_update(
+        update_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    )
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "bench",
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+                "text": "Экстренное сообщение",
+            },
+        },
+    }
+
+
+async def bench_fanout(sosBot, update_id):
+    started = time.perf_counter()
+    await sosBot.dp.feed_raw_update(sosBot.bot, command_update(update_id, "/notify Бенчмарк рассылки"))
+    elapsed = time.perf_counter() - started
+    incident_id = (await sosBot.get_last_incident())[0]
+    counts = await sosBot.get_outbox_counts(incident_id)
+    return incident_id, {
+        "elapsed_s": round(elapsed, 3),
+        "sent": counts["sent"],
+        "failed": counts["failed"],
+        "messages_per_s": round(counts["sent"] / elapsed, 1) if elapsed else None,
+    }
+
+
+async def bench_wizard(sosBot, update_id, scope):
+    """Инцидент через мастер: фото, геолокация и выбор области — путь finish_incident_creation."""
+    scope_button = {value: text for text, value in sosBot.DISPATCH_SCOPES.items()}[scope]
+    steps = [
+        {"text": "Создать инцидент"},
+        {"text": "Бенчмарк мастера"},
+        {"location": {"latitude": CENTER[0], "longitude": CENTER[1]}},
+        {"photo": [{"file_id": "bench-photo", "file_unique_id": "bench", "width": 1, "height": 1}]},
+    ]
+    for n, fields in enumerate(steps):
+        await sosBot.dp.feed_raw_update(sosBot.bot, admin_update(update_id + n, **fields))
+    # Последний шаг — выбор области — и есть рассылка
+    started = time.perf_counter()
+    await sosBot.dp.feed_raw_update(sosBot.bot, admin_update(update_id + len(steps), text=scope_button))
+    elapsed = time.perf_counter() - started
+    incident_id = (await sosBot.get_last_incident())[0]
+    counts = await sosBot.get_outbox_counts(incident_id)
+    nearby = await sosBot.get_nearby_users(CENTER[0], CENTER[1], sosBot.GEO_RADIUS_KM, sosBot.GEO_NEARBY_LIMIT)
+    return {
+        "scope": scope,
+        "nearby": len(nearby),
+        "elapsed_s": round(elapsed, 3),
+        "sent": counts["sent"],
+        "failed": counts["failed"],
+        "messages_per_s": round(counts["sent"] / elapsed, 1) if elapsed else None,
+    }
+
+
+async def bench_callbacks(sosBot, incident_id, users, count, concurrency, update_id):
+    rnd = random.Random(1)
+    latencies = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(n):
+        update = callback_update(
+            update_id + n, FIRST_USER_ID + rnd.randrange(users), f"{rnd.choice(('go', 'no'))}_{incident_id}"
+        )
+        async with slots:
+            started = time.perf_counter()
+            await sosBot.dp.feed_raw_update(sosBot.bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(count)))
+    handled = time.perf_counter() - started
+    # До конца записи: отложенные отклики уходят в очередь, ResponseWriter дописывает ее в БД
+    await sosBot.callback_gate.close()
+    await sosBot.response_writer.close()
+    persisted = time.perf_counter() - started
+    return {
+        "callbacks": count,
+        "concurrency": concurrency,
+        "handled_s": round(handled, 3),
+        "persisted_s": round(persisted, 3),
+        "callbacks_per_s": round(count / handled, 1) if handled else None,
+        **latency_summary(latencies),
+    }
+
+
+async def bench_report(sosBot, incident_id, update_id):
+    started = time.perf_counter()
+    await sosBot.dp.feed_raw_update(sosBot.bot, callback_update(update_id, ADMIN_ID, f"report_{incident_id}"))
+    first_screen = time.perf_counter() - started
+    # Полный проход по страницам "Не ответили" — как если бы админ листал до конца
+    page_latencies = []
+    after = 0
+    while True:
+        page_started = time.perf_counter()
+        _, markup, _ = await sosBot.build_report_page("m", incident_id, after)
+        page_latencies.append(time.perf_counter() - page_started)
+        next_data = [
+            button.callback_data for button in (markup.inline_keyboard[0] if markup else [])
+            if button.text.startswith("Далее")
+        ]
+        if not next_data:
+            break
+        after = int(next_data[0].rsplit("_", 1)[1])
+    return {
+        "first_screen_ms": round(first_screen * 1000, 2),
+        "missed_pages": len(page_latencies),
+        "page": latency_summary(page_latencies),
+    }
+
+
+async def run(args):
+    api = FakeBotAPI(config_from_args(args))
+    url = await api.start()
+    workdir = tempfile.mkdtemp(prefix="sosbot-bench-")
+    # Настройки бота читаются при импорте, поэтому окружение готовим до него
+    os.environ.update({
+        "API_TOKEN": "123456:BENCHMARK",
+        "TELEGRAM_API_URL": url,
+        "DB_FILE": os.path.join(workdir, "bench.db"),
+        "BROADCAST_RATE": str(args.broadcast_rate),
+        "STATS_UPDATE_INTERVAL": "0.5",
+        "ADMIN_SYNC_INTERVAL": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import sosBot
+
+    await sosBot.db_init()
+    started = time.perf_counter()
+    await sosBot.db.run(seed_database, args.users, args.incidents, args.response_rate, args.seed)
+    located = await sosBot.db.run(seed_locations, args.users, args.located_share, sosBot.geo_cell, args.seed)
+    seed_s = time.perf_counter() - started
+    await sosBot.admin_registry.load()
+    sosBot.response_writer.start()
+
+    result = {
+        "users": args.users,
+        "seed_incidents": args.incidents,
+        "seed_s": round(seed_s, 3),
+        "located_users": located,
+        "broadcast_rate": args.broadcast_rate,
+        "fake_api": vars(api.config),
+    }
+    try:
+        incident_id, result["fanout"] = await bench_fanout(sosBot, 1)
+        result["callbacks"] = await bench_callbacks(
+            sosBot, incident_id, args.users, args.callbacks, args.concurrency, 10
+        )
+        result["report"] = await bench_report(sosBot, incident_id, 10 + args.callbacks)
+        result["wizard_fanout"] = await bench_wizard(sosBot, 20 + args.callbacks, args.wizard_scope)
+    finally:
+        await sosBot.stats_updater.close()
+        await sosBot.db.close()
+        await sosBot.bot.session.close()
+        await api.stop()
+    result["api_calls"] = dict(sorted(api.calls.items()))
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--incidents", type=int, default=10, help="прошлых инцидентов с откликами")
+    parser.add_argument("--response-rate", type=float, default=0.3, help="доля откликнувшихся в прошлых инцидентах")
+    parser.add_argument("--callbacks", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно обрабатываемых колбэков")
+    parser.add_argument(
+        "--broadcast-rate", type=float, default=1000,
+        help="BROADCAST_RATE бота; 30 — как в проде, больше — чтобы мерить накладные расходы самого бота"
+    )
+    parser.add_argument("--located-share", type=float, default=0.3, help="доля пользователей с геолокацией")
+    parser.add_argument(
+        "--wizard-scope", default="nearby_first", choices=("all", "nearby_first", "nearby_only"),
+        help="область рассылки в сценарии мастера"
+    )
+    parser.add_argument("--output", default="", help="куда дополнительно записать JSON")
+    add_config_arguments(parser)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Микробенчмарк диспетчеризации: накладные расходы на апдейт, который не доходит до хендлера.
+
+Запуск: python benchmarks/dispatch_bench.py --iterations 20000 --output dispatch.json
+
+"legacy" — прежняя раскладка: все хендлеры на dp, линейная цепочка lambda-фильтров
+(хендлеры-заглушки, те же middleware и то же FSM-хранилище). "routers" — настоящий sosBot.dp.
+Апдейты разобраны заранее и подаются через dp.feed_update: мерится только маршрутизация.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from aiogram import Dispatcher, F
+from aiogram.filters import Command
+from aiogram.types import Update
+
+from bot_suite import ADMIN_ID, FIRST_USER_ID, callback_update, percentile
+from fake_bot_api import FakeBotAPI, FakeConfig
+
+GROUP_ID = -1001
+
+
+def group_update(update_id, **fields):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": GROUP_ID, "type": "supergroup", "title": "Группа"},
+            "from": {"id": FIRST_USER_ID, "is_bot": False, "first_name": "Участник"},
+            **fields,
+        },
+    }
+
+
+def private_update(update_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": FIRST_USER_ID, "type": "private", "first_name": "Участник"},
+            "from": {"id": FIRST_USER_ID, "is_bot": False, "first_name": "Участник"},
+            "text": text,
+        },
+    }
+
+
+SCENARIOS = {
+    "group_text": lambda n: group_update(n, text="Всем привет, кто сегодня на площади?"),
+    "group_sticker": lambda n: group_update(n, sticker={
+        "file_id": "s", "file_unique_id": "s", "type": "regular",
+        "width": 1, "height": 1, "is_animated": False, "is_video": False,
+    }),
+    "private_text": lambda n: private_update(n, "Просто сообщение боту"),
+    "unknown_callback": lambda n: callback_update(n, FIRST_USER_ID, "noop"),
+}
+
+
+def build_legacy_dispatcher(sosBot):
+    """Раскладка хендлеров до перехода на роутеры: порядок и фильтры как были, тела — заглушки."""
+    dp = Dispatcher(storage=sosBot.fsm_storage)
+    dp.update.outer_middleware(sosBot.MetricsMiddleware(sosBot.SLOW_HANDLER_THRESHOLD))
+    for event_name, observer in dp.observers.items():
+        if event_name not in ("update", "error"):
+            observer.middleware(sosBot.HandlerNameMiddleware())
+
+    async def noop(*args, **kwargs):
+        pass
+
+    wizard = sosBot.IncidentWizard
+    dp.message(F.chat.type == "private", F.text == "Отменить создание инцидента")(noop)
+    for name in ("init_admins", "add_admin", "remove_admin", "list_admins", "profile", "start", "help", "stop"):
+        dp.message(Command(name))(noop)
+    dp.message(lambda m: m.chat.type == "private" and m.text == "Отписаться от рассылки")(noop)
+    dp.message(lambda m: m.chat.type == "private" and m.text == "Подписаться на рассылку")(noop)
+    dp.message(F.chat.type == "private", F.text == "Создать инцидент")(noop)
+    dp.message(wizard.description, F.chat.type == "private", F.text)(noop)
+    dp.message(wizard.place, F.chat.type == "private", F.location)(noop)
+    dp.message(wizard.place, F.chat.type == "private", F.text)(noop)
+    dp.message(wizard.photo, F.chat.type == "private", F.photo)(noop)
+    dp.message(wizard.photo, F.chat.type == "private", F.text == "Пропустить")(noop)
+    dp.message(wizard.scope, F.chat.type == "private", F.text.in_(sosBot.DISPATCH_SCOPES))(noop)
+    dp.message(F.chat.type == "private", F.location)(noop)
+    dp.edited_message(F.chat.type == "private", F.location)(noop)
+    dp.callback_query(lambda c: c.data and c.data.startswith(("go_", "no_")))(noop)
+    for name in ("notify", "report"):
+        dp.message(Command(name))(noop)
+    dp.callback_query(lambda c: c.data and c.data.startswith("report_"))(noop)
+    dp.callback_query(lambda c: c.data and c.data.startswith("rp_"))(noop)
+    for name in ("sync_members", "stats"):
+        dp.message(Command(name))(noop)
+    # Прежний catch-all: совпадал с любым сообщением группы
+    dp.message(lambda m: m.chat.type in ("group", "supergroup"))(noop)
+    return dp
+
+
+async def measure(dp, bot, update, iterations):
+    for _ in range(min(iterations, 500)):
+        await dp.feed_update(bot, update)
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await dp.feed_update(bot, update)
+        timings.append(time.perf_counter() - started)
+    return {
+        "mean_us": round(sum(timings) / len(timings) * 1e6, 2),
+        "p50_us": round(percentile(timings, 0.5) * 1e6, 2),
+        "p99_us": round(percentile(timings, 0.99) * 1e6, 2),
+    }
+
+
+async def run(args):
+    api = FakeBotAPI(FakeConfig())
+    url = await api.start()
+    workdir = tempfile.mkdtemp(prefix="sosbot-dispatch-")
+    os.environ.update({
+        "API_TOKEN": "123456:BENCHMARK",
+        "TELEGRAM_API_URL": url,
+        "DB_FILE": os.path.join(workdir, "bench.db"),
+        "GROUP_CHAT_ID": str(GROUP_ID),
+        "ADMIN_SYNC_INTERVAL": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import sosBot
+
+    await sosBot.db_init()
+    layouts = {"legacy": build_legacy_dispatcher(sosBot), "routers": sosBot.dp}
+    result = {"iterations": args.iterations, "scenarios": {}}
+    try:
+        for name, make_update in SCENARIOS.items():
+            update = Update.model_validate(make_update(1), context={"bot": sosBot.bot})
+            timings = {layout: await measure(dp, sosBot.bot, update, args.iterations) for layout, dp in layouts.items()}
+            timings["speedup"] = round(timings["legacy"]["mean_us"] / timings["routers"]["mean_us"], 2)
+            result["scenarios"][name] = timings
+    finally:
+        await sosBot.fsm_storage.close()
+        await sosBot.db.close()
+        await sosBot.bot.session.close()
+        await api.stop()
+    # Заглушки ничего не отправляют, а sosBot.dp на эти апдейты не должен звать API
+    result["api_calls"] = dict(sorted(api.calls.items()))
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--output", default="", help="куда дополнительно записать JSON")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
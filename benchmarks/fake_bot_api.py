@@ -0,0 +1,193 @@
+"""Локальная замена Telegram Bot API: задержка ответа, 429 и ошибки доставки с заданной частотой.
+
+Отдельно:  python benchmarks/fake_bot_api.py --port 8081 --latency-ms 30 --rate-429 0.01
+Бот:       TELEGRAM_API_URL=http://127.0.0.1:8081 python sosBot.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass
+
+from aiohttp import web
+
+
+@dataclass
+class FakeConfig:
+    latency_ms: float = 0.0     # средняя задержка ответа
+    jitter_ms: float = 0.0      # равномерный разброс задержки +-
+    rate_429: float = 0.0       # доля ответов 429 на отправку сообщений
+    retry_after: int = 1        # retry_after в ответе 429
+    rate_blocked: float = 0.0   # доля получателей, заблокировавших бота (403)
+    rate_not_found: float = 0.0 # доля несуществующих чатов (400 chat not found)
+    rate_left: float = 0.0      # доля пользователей, вышедших из группы (getChatMember)
+    seed: int = 0
+
+
+# Методы, на которые действуют 429 и ошибки получателя
+SEND_METHODS = {"sendMessage", "sendPhoto"}
+
+
+class FakeBotAPI:
+    """Отвечает на /bot<token>/<method> как Bot API; считает вызовы по методам и исходам."""
+
+    def __init__(self, config):
+        self.config = config
+        self.calls = {}
+        self._random = random.Random(config.seed)
+        self._message_id = 0
+        self._runner = None
+        # Недоставляемость — свойство чата, а не отдельного запроса: решение запоминается
+        self._chat_fate = {}
+
+    def _count(self, key):
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    def _fate(self, chat_id):
+        fate = self._chat_fate.get(chat_id)
+        if fate is None:
+            roll = self._random.random()
+            if roll < self.config.rate_blocked:
+                fate = "blocked"
+            elif roll < self.config.rate_blocked + self.config.rate_not_found:
+                fate = "not_found"
+            else:
+                fate = "ok"
+            self._chat_fate[chat_id] = fate
+        return fate
+
+    def _message(self, chat_id, **fields):
+        self._message_id += 1
+        chat_id = int(chat_id)
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        if chat_id < 0:
+            chat["title"] = "fake"
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": chat, **fields}
+
+    @staticmethod
+    def _error(code, description, **parameters):
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if self.config.latency_ms or self.config.jitter_ms:
+            delay = self.config.latency_ms + self._random.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+            await asyncio.sleep(max(0.0, delay) / 1000)
+
+        if method in SEND_METHODS:
+            if self._random.random() < self.config.rate_429:
+                self._count(f"{method}:429")
+                return self._error(
+                    429, f"Too Many Requests: retry after {self.config.retry_after}",
+                    retry_after=self.config.retry_after
+                )
+            fate = self._fate(params.get("chat_id"))
+            if fate == "blocked":
+                self._count(f"{method}:403")
+                return self._error(403, "Forbidden: bot was blocked by the user")
+            if fate == "not_found":
+                self._count(f"{method}:400")
+                return self._error(400, "Bad Request: chat not found")
+
+        if method == "getChatMember" and self._fate(params.get("user_id")) == "not_found":
+            self._count(f"{method}:400")
+            return self._error(400, "Bad Request: user not found")
+
+        self._count(method)
+        if method == "sendMessage":
+            result = self._message(params["chat_id"], text=params.get("text", ""))
+        elif method == "sendPhoto":
+            photo = {"file_id": params.get("photo", "photo"), "file_unique_id": "u", "width": 1, "height": 1}
+            result = self._message(params["chat_id"], photo=[photo], caption=params.get("caption", ""))
+        elif method.startswith("send"):
+            # sendDocument и прочие отправки: содержимое в ответе боту не нужно
+            result = self._message(params["chat_id"])
+        elif method in ("editMessageText", "editMessageCaption"):
+            result = self._message(params["chat_id"], text=params.get("text") or params.get("caption", ""))
+            result["message_id"] = int(params["message_id"])
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            left = random.Random(user_id ^ self.config.seed).random() < self.config.rate_left
+            result = {
+                "status": "left" if left else "member",
+                "user": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            }
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        elif method == "getUpdates":
+            # Апдейтов нет: ведем себя как long polling с коротким таймаутом
+            await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+            result = []
+        else:
+            # editMessageReplyMarkup, answerCallbackQuery, pinChatMessage, deleteWebhook и т.п.
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Запускает сервер и возвращает его базовый URL для TELEGRAM_API_URL."""
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def add_config_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--rate-blocked", type=float, default=0.0)
+    parser.add_argument("--rate-not-found", type=float, default=0.0)
+    parser.add_argument("--rate-left", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def config_from_args(args):
+    return FakeConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429,
+        retry_after=args.retry_after, rate_blocked=args.rate_blocked, rate_not_found=args.rate_not_found,
+        rate_left=args.rate_left, seed=args.seed,
+    )
+
+
+async def serve(args):
+    api = FakeBotAPI(config_from_args(args))
+    url = await api.start(args.host, args.port)
+    print(f"Fake Bot API: {url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+        print(json.dumps(api.calls, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_config_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Локальный "Telegram": шлет синтетические апдейты на webhook бота и меряет задержку ответа.
+
+Запуск бота:   BOT_MODE=webhook WEBHOOK_SECRET=test python sosBot.py
+Запуск клиента: python benchmarks/webhook_client.py --secret test --updates 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+
+def group_message(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": 100000 + update_id % 1000, "is_bot": False, "first_name": "Bench"},
+            "text": f"сообщение {update_id}",
+        },
+    }
+
+
+def callback_query(update_id, chat_id):
+    user_id = 100000 + update_id % 1000
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "bench",
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "data": f"go_{1 + update_id % 3}",
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+                "text": "Экстренное сообщение",
+            },
+        },
+    }
+
+
+UPDATE_KINDS = {"group": group_message, "callback": callback_query}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def run(args):
+    make_update = UPDATE_KINDS[args.kind]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    latencies = []
+    statuses = {}
+    next_id = iter(range(1, args.updates + 1))
+
+    async def worker(session):
+        for update_id in next_id:
+            started = time.perf_counter()
+            async with session.post(args.url, json=make_update(update_id, args.chat_id), headers=headers) as resp:
+                await resp.read()
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "kind": args.kind,
+        "updates": args.updates,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(args.updates / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "statuses": statuses,
+    }, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--kind", choices=sorted(UPDATE_KINDS), default="group")
+    parser.add_argument("--chat-id", type=int, default=-1000000000000)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
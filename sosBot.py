@@ -1,16 +1,47 @@
 import asyncio
+import atexit
+import cProfile
+import io
+import json
+import pstats
+import functools
+import heapq
+import hmac
+import html
 import logging
+import math
 import sqlite3
 import os
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command, CommandObject
-from aiogram.enums import ParseMode
+import queue
+import random
+import signal
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types, F
+from aiogram.filters import Command, CommandObject, Filter, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.enums import ContentType, ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import (
-    InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, ReplyKeyboardMarkup
+    BufferedInputFile, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, ReplyKeyboardMarkup
 )
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
 from dotenv import load_dotenv
+
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен: без него расстояния считаются обычным циклом
+    np = None
 from datetime import datetime, timedelta, timezone
 
 # === НАСТРОЙКИ ===
@@ -18,33 +49,297 @@ load_dotenv()
 API_TOKEN = os.getenv("API_TOKEN")
 DB_FILE = os.getenv("DB_FILE", "security_bot.db")
 GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "-1000000000000"))  # Ваш chat_id группы
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))  # сообщений в секунду на весь бот (лимит Telegram ~30)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))  # одновременных запросов при рассылке
+PER_CHAT_INTERVAL = float(os.getenv("PER_CHAT_INTERVAL", "1.0"))  # секунд между сообщениями в один чат
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))  # повторов при 429
+STATS_UPDATE_INTERVAL = float(os.getenv("STATS_UPDATE_INTERVAL", "3"))  # секунд между правками закрепленной статистики
+RESPONSE_BATCH_SIZE = int(os.getenv("RESPONSE_BATCH_SIZE", "200"))  # откликов в одной транзакции
+RESPONSE_FLUSH_INTERVAL = float(os.getenv("RESPONSE_FLUSH_INTERVAL", "0.05"))  # секунд накопления пачки
+RESPONSE_QUEUE_SIZE = int(os.getenv("RESPONSE_QUEUE_SIZE", "10000"))  # при заполнении колбэки ждут запись
+CALLBACK_USER_INTERVAL = float(os.getenv("CALLBACK_USER_INTERVAL", "1"))  # секунд между записями откликов одного пользователя
+CALLBACK_CACHE_SIZE = int(os.getenv("CALLBACK_CACHE_SIZE", "10000"))  # записей в LRU последних откликов
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))  # пользователей в LRU-кэше тегов
+REPORT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", "50"))  # строк на страницу отчета
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))  # строк outbox, забираемых воркером за раз
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "3"))  # попыток доставки до состояния failed
+OUTBOX_CLAIM_TIMEOUT = int(os.getenv("OUTBOX_CLAIM_TIMEOUT", "120"))  # секунд без продления, после которых захват считается брошенным
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))  # секунд между проверками незавершенных рассылок
+ADMIN_SYNC_INTERVAL = float(os.getenv("ADMIN_SYNC_INTERVAL", "10"))  # секунд между проверками внешних изменений админов и закрытых инцидентов, 0 — выкл.
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com; пусто — setWebhook не вызывается
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token, обязателен в режиме webhook
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # порт /metrics в формате Prometheus, 0 — выкл.
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))  # апдейтов, обрабатываемых одновременно
+# Свой Bot API сервер: локальный telegram-bot-api или фейк из benchmarks/; пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+SLOW_HANDLER_THRESHOLD = float(os.getenv("SLOW_HANDLER_THRESHOLD", "1.0"))  # секунд; медленные хендлеры попадают в лог
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))  # предел окна /profile
+GEO_RADIUS_KM = float(os.getenv("GEO_RADIUS_KM", "5"))  # радиус "ближайших" при рассылке по геолокации
+GEO_NEARBY_LIMIT = int(os.getenv("GEO_NEARBY_LIMIT", "0"))  # не больше K ближайших, 0 — все в радиусе
+GEO_CELL_DEG = 0.1  # размер ячейки сетки user_locations в градусах (~11 км по широте)
+BROADCAST_TIERS = int(os.getenv("BROADCAST_TIERS", "3"))  # ярусов рассылки по отзывчивости, 1 — без приоритета
+STATS_LIST_LIMIT = int(os.getenv("STATS_LIST_LIMIT", "100"))  # имен в списке "Пойдут" закрепленного сообщения
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "10"))  # одновременных get_chat_member при /sync_members
+SYNC_RATE = float(os.getenv("SYNC_RATE", "20"))  # запросов в секунду при /sync_members, отдельно от лимита рассылки
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "500"))  # пользователей в одной транзакции сверки
+SYNC_PROGRESS_INTERVAL = float(os.getenv("SYNC_PROGRESS_INTERVAL", "5"))  # секунд между обновлениями прогресса
+WIZARD_TTL = int(os.getenv("WIZARD_TTL", "3600"))  # секунд бездействия, после которых черновик инцидента удаляется
+WIZARD_MAX_DRAFTS = int(os.getenv("WIZARD_MAX_DRAFTS", "1000"))  # черновиков в хранилище, старые вытесняются
+FSM_SYNC_INTERVAL = float(os.getenv("FSM_SYNC_INTERVAL", "0.5"))  # секунд, не чаще которых кэш черновиков сверяется с БД
+# Минут от создания инцидента до каждого напоминания не ответившим, через запятую; пусто — без напоминаний
+FOLLOWUP_MINUTES = [int(m) for m in os.getenv("FOLLOWUP_MINUTES", "10,30").split(",") if m.strip()]
+
+# Лимиты Telegram на длину текста сообщения и подписи к фото
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
 
 # === ВРЕМЯ МОСКВЫ ===
 MOSCOW_TZ = timezone(timedelta(hours=3))
 
-def utc_to_msk(dt_str):
-    """Преобразует строку UTC-времени из SQLite в строку московского времени."""
+def utc_to_msk(dt):
+    """Преобразует UTC-время из SQLite (секунды эпохи) в строку московского времени."""
     try:
-        dt_utc = datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-        dt_msk = dt_utc.astastimezone(MOSCOW_TZ)
-        return dt_msk.strftime("%d.%m.%Y %H:%M") + " МСК"
+        if isinstance(dt, str):
+            dt = datetime.strptime(dt, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+        return datetime.fromtimestamp(dt, MOSCOW_TZ).strftime("%d.%m.%Y %H:%M") + " МСК"
     except Exception:
-        return dt_str
+        return str(dt)
 
 # === ЛОГИРОВАНИЕ ===
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
+# Event loop только кладет запись в очередь; форматирование и вывод — в потоке QueueListener.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Доля записываемых событий log_event, например "callback=0.1,group_message=0"
+LOG_SAMPLING = {
+    name.strip(): float(rate)
+    for name, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLING", "").split(","))
+    if rate
+}
+
+class LazyQueueHandler(QueueHandler):
+    """В отличие от QueueHandler не форматирует запись в вызывающем потоке."""
+
+    def prepare(self, record):
+        return record
+
+class KV:
+    """Поля события, которые склеиваются в key=value только при выводе записи."""
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join(
+            f"{key}={value!r}" if isinstance(value, str) and (" " in value or not value) else f"{key}={value}"
+            for key, value in self.fields.items()
+        )
+
+log_queue = queue.SimpleQueue()
+log_output = logging.StreamHandler()
+log_output.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_output, respect_handler_level=True)
+logging.basicConfig(level=LOG_LEVEL, handlers=[LazyQueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger("security_bot")
 
-def db_connect():
-    return sqlite3.connect(DB_FILE)
+def log_event(event, level=logging.INFO, **fields):
+    """Структурированная запись "event key=value ..." с семплированием по LOG_SAMPLING."""
+    if not logger.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLING.get(event, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    logger.log(level, "%s %s", event, KV(fields))
+
+# === МЕТРИКИ ===
+# Минимальная реализация текстового формата Prometheus. Все метрики обновляются из event loop.
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BROADCAST_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # key: [счетчики по корзинам..., сумма, количество]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def samples(self):
+        for key, data in self._values.items():
+            for bound, count in zip(self.buckets, data):
+                yield f"{self.name}_bucket", format_labels(self.labels + ("le",), key + (bound,)), count
+            yield f"{self.name}_bucket", format_labels(self.labels + ("le",), key + ("+Inf",)), data[-1]
+            yield f"{self.name}_sum", format_labels(self.labels, key), data[-2]
+            yield f"{self.name}_count", format_labels(self.labels, key), data[-1]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+BROADCAST_SECONDS = metrics.register(Histogram(
+    "sosbot_broadcast_duration_seconds", "Полное время рассылки", buckets=BROADCAST_BUCKETS))
+SEND_SECONDS = metrics.register(Histogram(
+    "sosbot_send_latency_seconds", "Время одного запроса отправки к Telegram"))
+SEND_FAILURES = metrics.register(Counter(
+    "sosbot_send_failures_total", "Неудачные отправки по причине", labels=("reason",)))
+RETRY_AFTER = metrics.register(Counter(
+    "sosbot_telegram_429_total", "Ответы 429 Too Many Requests от Telegram"))
+UPDATE_SECONDS = metrics.register(Histogram(
+    "sosbot_update_handling_seconds", "Время обработки апдейта", labels=("type",)))
+UPDATES_IN_FLIGHT = metrics.register(Gauge(
+    "sosbot_updates_in_flight", "Апдейты в обработке"))
+CALLBACKS_DROPPED = metrics.register(Counter(
+    "sosbot_callbacks_dropped_total", "Отклики, отброшенные до записи в БД", labels=("reason",)))
+DB_SECONDS = metrics.register(Histogram(
+    "sosbot_db_call_seconds", "Время вызова функции БД, включая ожидание потока БД", labels=("helper",)))
+
+async def run_metrics_server(host, port):
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# === БАЗА ДАННЫХ ===
+
+class Database:
+    """Одно долгоживущее соединение SQLite, все запросы идут в отдельном потоке."""
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            # cached_statements — переиспользование подготовленных запросов
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA cache_size=-16000")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._conn = conn
+        return self._conn
+
+    def _call(self, fn, args, kwargs):
+        conn = self._connection()
+        try:
+            return fn(conn, *args, **kwargs)
+        except Exception:
+            # Соединение общее: недописанная транзакция упавшего хелпера не должна закоммититься чужим commit()
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args, kwargs)
+
+    async def close(self):
+        if self._conn is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+db = Database(DB_FILE)
+
+def db_task(fn):
+    """Превращает fn(conn, ...) в корутину, выполняемую в потоке БД."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await db.run(fn, *args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, helper=fn.__name__)
+    return wrapper
+
+# === МИГРАЦИИ СХЕМЫ ===
+# Номер примененной миграции хранится в PRAGMA user_version.
+# Новые изменения схемы — только новой функцией в конце MIGRATIONS.
 
-def db_init():
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
+EPOCH_NOW = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+def migration_base_schema(conn):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -54,7 +349,7 @@ def db_init():
         )
     """)
     # ДОБАВИЛ creator_id
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS incidents (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             text TEXT NOT NULL,
@@ -65,7 +360,7 @@ def db_init():
             creator_id INTEGER
         )
     """)
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS responses (
             incident_id INTEGER,
             user_id INTEGER,
@@ -76,169 +371,777 @@ def db_init():
             PRIMARY KEY (incident_id, user_id)
         )
     """)
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS admins (
             user_id INTEGER PRIMARY KEY
         )
     """)
+
+def migration_epoch_timestamps(conn):
+    # dt хранится как целые секунды UTC: дешевые диапазонные выборки и конвертация в МСК
+    conn.execute(f"""
+        CREATE TABLE incidents_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            place TEXT,
+            photo_id TEXT,
+            dt INTEGER NOT NULL DEFAULT {EPOCH_NOW},
+            stats_msg_id INTEGER,
+            creator_id INTEGER
+        )
+    """)
+    conn.execute(f"""
+        INSERT INTO incidents_new (id, text, place, photo_id, dt, stats_msg_id, creator_id)
+        SELECT id, text, place, photo_id, COALESCE(CAST(strftime('%s', dt) AS INTEGER), {EPOCH_NOW}),
+               stats_msg_id, creator_id
+        FROM incidents
+    """)
+    conn.execute("DROP TABLE incidents")
+    conn.execute("ALTER TABLE incidents_new RENAME TO incidents")
+    conn.execute(f"""
+        CREATE TABLE responses_new (
+            incident_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            lat REAL,
+            lon REAL,
+            dt INTEGER NOT NULL DEFAULT {EPOCH_NOW},
+            PRIMARY KEY (incident_id, user_id)
+        )
+    """)
+    conn.execute(f"""
+        INSERT INTO responses_new (incident_id, user_id, status, lat, lon, dt)
+        SELECT incident_id, user_id, status, lat, lon, COALESCE(CAST(strftime('%s', dt) AS INTEGER), {EPOCH_NOW})
+        FROM responses
+    """)
+    conn.execute("DROP TABLE responses")
+    conn.execute("ALTER TABLE responses_new RENAME TO responses")
+
+def migration_hot_query_indexes(conn):
+    # get_recent_incidents: ORDER BY dt
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_incidents_dt ON incidents (dt)")
+    # get_go_members и отчеты: фильтр по (incident_id, status), user_id для JOIN без обращения к таблице
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_incident_status ON responses (incident_id, status, user_id)")
+    # /add_admin и /remove_admin по @username
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+    # Выборки участников: WHERE is_member=1, покрывающий для user_id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_member ON users (is_member, user_id)")
+
+def migration_outbox(conn):
+    # Одна строка на (инцидент, получатель): pending -> sending -> sent / failed
+    conn.execute(f"""
+        CREATE TABLE outbox (
+            incident_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at INTEGER,
+            message_id INTEGER,
+            error TEXT,
+            updated_at INTEGER NOT NULL DEFAULT {EPOCH_NOW},
+            PRIMARY KEY (incident_id, user_id)
+        )
+    """)
+    conn.execute("CREATE INDEX idx_outbox_state ON outbox (state, incident_id)")
+
+def migration_delivery_health(conn):
+    # undeliverable: 'blocked' / 'not_found' — рассылка таким пользователям не идет до /start
+    conn.execute("ALTER TABLE users ADD COLUMN undeliverable TEXT")
+    conn.execute("ALTER TABLE users ADD COLUMN undeliverable_at INTEGER")
+    conn.execute("ALTER TABLE users ADD COLUMN transient_failures INTEGER NOT NULL DEFAULT 0")
+    # outbox_enqueue: только доставляемые участники
+    conn.execute("CREATE INDEX idx_users_deliverable ON users (user_id) WHERE is_member=1 AND undeliverable IS NULL")
+
+def migration_geo(conn):
+    # Последняя геолокация подписчика; (cell_lat, cell_lon) — ячейка сетки GEO_CELL_DEG для выборки по радиусу
+    conn.execute(f"""
+        CREATE TABLE user_locations (
+            user_id INTEGER PRIMARY KEY,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            cell_lat INTEGER NOT NULL,
+            cell_lon INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL DEFAULT {EPOCH_NOW}
+        )
+    """)
+    conn.execute("CREATE INDEX idx_user_locations_cell ON user_locations (cell_lat, cell_lon)")
+    conn.execute("ALTER TABLE incidents ADD COLUMN lat REAL")
+    conn.execute("ALTER TABLE incidents ADD COLUMN lon REAL")
+    # Меньший priority забирается из outbox раньше: ближайшим рассылка уходит первой
+    conn.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+    conn.execute("DROP INDEX idx_outbox_state")
+    conn.execute("CREATE INDEX idx_outbox_state ON outbox (state, incident_id, priority)")
+
+# Отзывчивость получателя: сглаженная доля "Пойду" от доставленных, штраф за медленный отклик.
+# Без истории: (0 + 1) / (0 + 2) / (1 + 300 / 300) = 0.25 — это же значение в COALESCE для новых пользователей.
+USER_SCORE_SQL = "(go_count + 1.0) / (MAX(notified, go_count + no_count) + 2.0) / (1.0 + COALESCE(median_delay, 300.0) / 300.0)"
+NEW_USER_SCORE = 0.25
+
+def migration_user_stats(conn):
+    # Счетчики ведут триггеры на outbox и responses — пересчитывать историю на каждый инцидент не нужно
+    conn.execute(f"""
+        CREATE TABLE user_stats (
+            user_id INTEGER PRIMARY KEY,
+            notified INTEGER NOT NULL DEFAULT 0,
+            go_count INTEGER NOT NULL DEFAULT 0,
+            no_count INTEGER NOT NULL DEFAULT 0,
+            median_delay REAL,
+            score REAL GENERATED ALWAYS AS ({USER_SCORE_SQL}) STORED
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER user_stats_notified AFTER UPDATE OF state ON outbox
+        WHEN NEW.state='sent' AND OLD.state<>'sent'
+        BEGIN
+            INSERT INTO user_stats (user_id, notified) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET notified=notified+1;
+        END
+    """)
+    # median_delay — потоковая оценка медианы (frugal streaming): шаг к новому значению, а не среднее,
+    # поэтому единичный отклик через сутки не портит оценку
+    conn.execute("""
+        CREATE TRIGGER user_stats_response AFTER INSERT ON responses
+        BEGIN
+            INSERT INTO user_stats (user_id) VALUES (NEW.user_id) ON CONFLICT (user_id) DO NOTHING;
+            UPDATE user_stats SET
+                go_count = go_count + (NEW.status='Пойду'),
+                no_count = no_count + (NEW.status='Не могу'),
+                median_delay = (
+                    SELECT CASE
+                        WHEN d IS NULL THEN median_delay
+                        WHEN median_delay IS NULL THEN d
+                        WHEN d > median_delay THEN median_delay + MIN(d - median_delay, 1 + median_delay / 16)
+                        ELSE median_delay - MIN(median_delay - d, 1 + median_delay / 16)
+                    END
+                    FROM (
+                        SELECT MAX(MAX(NEW.dt - o.updated_at), 0) AS d
+                        FROM outbox o
+                        WHERE o.incident_id=NEW.incident_id AND o.user_id=NEW.user_id AND o.state='sent'
+                    )
+                )
+            WHERE user_id=NEW.user_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER user_stats_response_changed AFTER UPDATE OF status ON responses
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE user_stats SET
+                go_count = go_count + (NEW.status='Пойду') - (OLD.status='Пойду'),
+                no_count = no_count + (NEW.status='Не могу') - (OLD.status='Не могу')
+            WHERE user_id=NEW.user_id;
+        END
+    """)
+    # Начальные значения из накопленной истории (без задержек — их для старых откликов не восстановить)
+    conn.execute("""
+        INSERT INTO user_stats (user_id, notified, go_count, no_count)
+        SELECT user_id, SUM(notified), SUM(go), SUM(no)
+        FROM (
+            SELECT user_id, 1 AS notified, 0 AS go, 0 AS no FROM outbox WHERE state='sent'
+            UNION ALL
+            SELECT user_id, 0, status='Пойду', status='Не могу' FROM responses
+        )
+        GROUP BY user_id
+    """)
+
+def migration_incident_stats(conn):
+    # Счетчики по инциденту для закрепа и /report; ведутся триггерами, как user_stats
+    conn.execute("""
+        CREATE TABLE incident_stats (
+            incident_id INTEGER PRIMARY KEY,
+            notified INTEGER NOT NULL DEFAULT 0,
+            go_count INTEGER NOT NULL DEFAULT 0,
+            no_count INTEGER NOT NULL DEFAULT 0,
+            last_response_at INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER incident_stats_notified AFTER UPDATE OF state ON outbox
+        WHEN NEW.state='sent' AND OLD.state<>'sent'
+        BEGIN
+            INSERT INTO incident_stats (incident_id, notified) VALUES (NEW.incident_id, 1)
+            ON CONFLICT (incident_id) DO UPDATE SET notified=notified+1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER incident_stats_response AFTER INSERT ON responses
+        BEGIN
+            INSERT INTO incident_stats (incident_id, go_count, no_count, last_response_at)
+            VALUES (NEW.incident_id, NEW.status='Пойду', NEW.status='Не могу', NEW.dt)
+            ON CONFLICT (incident_id) DO UPDATE SET
+                go_count=go_count+excluded.go_count, no_count=no_count+excluded.no_count,
+                last_response_at=excluded.last_response_at;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER incident_stats_response_changed AFTER UPDATE OF status ON responses
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE incident_stats SET
+                go_count = go_count + (NEW.status='Пойду') - (OLD.status='Пойду'),
+                no_count = no_count + (NEW.status='Не могу') - (OLD.status='Не могу'),
+                last_response_at = NEW.dt
+            WHERE incident_id=NEW.incident_id;
+        END
+    """)
+    conn.execute("ALTER TABLE user_stats ADD COLUMN last_response_at INTEGER")
+    # Время последнего отклика — в тех же триггерах user_stats (порядок срабатывания разных триггеров не гарантирован)
+    conn.execute("DROP TRIGGER user_stats_response")
+    conn.execute("""
+        CREATE TRIGGER user_stats_response AFTER INSERT ON responses
+        BEGIN
+            INSERT INTO user_stats (user_id) VALUES (NEW.user_id) ON CONFLICT (user_id) DO NOTHING;
+            UPDATE user_stats SET
+                go_count = go_count + (NEW.status='Пойду'),
+                no_count = no_count + (NEW.status='Не могу'),
+                last_response_at = NEW.dt,
+                median_delay = (
+                    SELECT CASE
+                        WHEN d IS NULL THEN median_delay
+                        WHEN median_delay IS NULL THEN d
+                        WHEN d > median_delay THEN median_delay + MIN(d - median_delay, 1 + median_delay / 16)
+                        ELSE median_delay - MIN(median_delay - d, 1 + median_delay / 16)
+                    END
+                    FROM (
+                        SELECT MAX(MAX(NEW.dt - o.updated_at), 0) AS d
+                        FROM outbox o
+                        WHERE o.incident_id=NEW.incident_id AND o.user_id=NEW.user_id AND o.state='sent'
+                    )
+                )
+            WHERE user_id=NEW.user_id;
+        END
+    """)
+    conn.execute("DROP TRIGGER user_stats_response_changed")
+    conn.execute("""
+        CREATE TRIGGER user_stats_response_changed AFTER UPDATE OF status ON responses
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE user_stats SET
+                go_count = go_count + (NEW.status='Пойду') - (OLD.status='Пойду'),
+                no_count = no_count + (NEW.status='Не могу') - (OLD.status='Не могу'),
+                last_response_at = NEW.dt
+            WHERE user_id=NEW.user_id;
+        END
+    """)
+    # /stats: самые надежные без сортировки всей таблицы
+    conn.execute("CREATE INDEX idx_user_stats_score ON user_stats (score)")
+    conn.execute("""
+        INSERT INTO incident_stats (incident_id, notified, go_count, no_count, last_response_at)
+        SELECT incident_id, SUM(notified), SUM(go), SUM(no), MAX(dt)
+        FROM (
+            SELECT incident_id, 1 AS notified, 0 AS go, 0 AS no, NULL AS dt FROM outbox WHERE state='sent'
+            UNION ALL
+            SELECT incident_id, 0, status='Пойду', status='Не могу', dt FROM responses
+        )
+        GROUP BY incident_id
+    """)
+    conn.execute("""
+        UPDATE user_stats SET last_response_at=(SELECT MAX(dt) FROM responses r WHERE r.user_id=user_stats.user_id)
+    """)
+
+def migration_fsm_states(conn):
+    # Черновики мастера создания инцидента переживают рестарт
+    conn.execute("""
+        CREATE TABLE fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX idx_fsm_states_updated ON fsm_states (updated_at)")
+
+def migration_followups(conn):
+    # Раунды напоминаний: строка на (инцидент, раунд); started_at проставляет процесс, взявший раунд
+    conn.execute("""
+        CREATE TABLE followups (
+            incident_id INTEGER NOT NULL,
+            round INTEGER NOT NULL,
+            due_at INTEGER NOT NULL,
+            started_at INTEGER,
+            sent INTEGER,
+            failed INTEGER,
+            PRIMARY KEY (incident_id, round)
+        )
+    """)
+    # Загрузка таймеров при старте: только невыполненные раунды
+    conn.execute("CREATE INDEX idx_followups_pending ON followups (due_at) WHERE started_at IS NULL")
+
+def migration_incident_close(conn):
+    # closed_at: /close — отклики больше не принимаются, кнопки у получателей убраны
+    conn.execute("ALTER TABLE incidents ADD COLUMN closed_at INTEGER")
+    conn.execute("CREATE INDEX idx_incidents_closed ON incidents (id) WHERE closed_at IS NOT NULL")
+
+# Шаг потоковой медианы задержки отклика к новому значению {d} (см. migration_user_stats)
+MEDIAN_DELAY_STEP_SQL = """
+    CASE
+        WHEN {d} IS NULL THEN median_delay
+        WHEN median_delay IS NULL THEN {d}
+        WHEN {d} > median_delay THEN median_delay + MIN({d} - median_delay, 1 + median_delay / 16)
+        ELSE median_delay - MIN(median_delay - {d}, 1 + median_delay / 16)
+    END
+"""
+
+def migration_outbox_sent_at(conn):
+    # Время доставки конкретному получателю: outbox_finish пишет state только после всей пачки,
+    # и задержка отклика от updated_at считалась от конца пачки, а ответившие до ее конца не учитывались
+    conn.execute("ALTER TABLE outbox ADD COLUMN sent_at INTEGER")
+    conn.execute("UPDATE outbox SET sent_at=updated_at WHERE state='sent'")
+    conn.execute("DROP TRIGGER user_stats_response")
+    conn.execute(f"""
+        CREATE TRIGGER user_stats_response AFTER INSERT ON responses
+        BEGIN
+            INSERT INTO user_stats (user_id) VALUES (NEW.user_id) ON CONFLICT (user_id) DO NOTHING;
+            UPDATE user_stats SET
+                go_count = go_count + (NEW.status='Пойду'),
+                no_count = no_count + (NEW.status='Не могу'),
+                last_response_at = NEW.dt,
+                median_delay = (
+                    SELECT {MEDIAN_DELAY_STEP_SQL.format(d="d")}
+                    FROM (
+                        SELECT MAX(MAX(NEW.dt - o.sent_at), 0) AS d
+                        FROM outbox o
+                        WHERE o.incident_id=NEW.incident_id AND o.user_id=NEW.user_id AND o.sent_at IS NOT NULL
+                    )
+                )
+            WHERE user_id=NEW.user_id;
+        END
+    """)
+    # Отклик пришел, пока пачка еще рассылалась: задержку считаем, когда sent_at будет записан
+    conn.execute(f"""
+        CREATE TRIGGER user_stats_delivered AFTER UPDATE OF sent_at ON outbox
+        WHEN OLD.sent_at IS NULL AND NEW.sent_at IS NOT NULL
+        BEGIN
+            UPDATE user_stats SET
+                median_delay = (
+                    SELECT {MEDIAN_DELAY_STEP_SQL.format(d="d")}
+                    FROM (
+                        SELECT MAX(MAX(r.dt - NEW.sent_at), 0) AS d
+                        FROM responses r
+                        WHERE r.incident_id=NEW.incident_id AND r.user_id=NEW.user_id
+                    )
+                )
+            WHERE user_id=NEW.user_id;
+        END
+    """)
+
+def migration_recall(conn):
+    # Напоминания несут те же кнопки, что и оповещение: их message_id нужны /close.
+    # recalled_at — сообщение уже забрано на отзыв (см. claim_recall)
+    conn.execute("""
+        CREATE TABLE followup_messages (
+            incident_id INTEGER NOT NULL,
+            round INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            recalled_at INTEGER,
+            PRIMARY KEY (incident_id, round, user_id)
+        )
+    """)
+    conn.execute("ALTER TABLE outbox ADD COLUMN recalled_at INTEGER")
+    # /close ... delete: доставленные после закрытия сообщения отзываются так же
+    conn.execute("ALTER TABLE incidents ADD COLUMN recall_delete INTEGER NOT NULL DEFAULT 0")
+
+def migration_drop_transient_failures(conn):
+    # Счетчик временных сбоев никто не читал: недоставляемыми помечают только постоянные ошибки
+    conn.execute("ALTER TABLE users DROP COLUMN transient_failures")
+
+MIGRATIONS = [
+    migration_base_schema,
+    migration_epoch_timestamps,
+    migration_hot_query_indexes,
+    migration_outbox,
+    migration_delivery_health,
+    migration_geo,
+    migration_user_stats,
+    migration_incident_stats,
+    migration_fsm_states,
+    migration_followups,
+    migration_incident_close,
+    migration_outbox_sent_at,
+    migration_recall,
+    migration_drop_transient_failures,
+]
+
+@db_task
+def db_init(conn):
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        # IMMEDIATE: если бот запущен в нескольких процессах, миграцию применит только один
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= number:
+                conn.rollback()
+                continue
+            logger.info("Применяю миграцию %s: %s", number, migration.__name__)
+            migration(conn)
+            conn.execute(f"PRAGMA user_version={number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    logger.info("База данных инициализирована (версия схемы %s).", len(MIGRATIONS))
+
+@db_task
+def db_save_admin(conn, user_id):
+    logger.info("Сохраняю user_id=%s в admins", user_id)
+    conn.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
     conn.commit()
-    conn.close()
-    logger.info("База данных инициализирована.")
-
-def save_admin(user_id):
-    logger.info(f"Сохраняю user_id={user_id} в admins")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
 
-def delete_admin(user_id):
-    logger.info(f"Удаляю user_id={user_id} из admins")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
+@db_task
+def db_delete_admin(conn, user_id):
+    logger.info("Удаляю user_id=%s из admins", user_id)
+    conn.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
     conn.commit()
-    conn.close()
 
-def is_admin(user_id):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM admins WHERE user_id=?", (user_id,))
-    result = cur.fetchone()
-    conn.close()
-    logger.info(f"Проверка is_admin для user_id={user_id}: {bool(result)}")
-    return bool(result)
-
-def get_admins():
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM admins")
-    rows = cur.fetchall()
-    conn.close()
+@db_task
+def get_data_version(conn):
+    # Меняется, когда другое соединение (другой процесс) фиксирует изменения в БД
+    return conn.execute("PRAGMA data_version").fetchone()[0]
+
+@db_task
+def get_admins(conn):
+    rows = conn.execute("SELECT user_id FROM admins").fetchall()
     return [row[0] for row in rows]
 
-def get_group_members():
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users WHERE is_member=1")
-    users = [row[0] for row in cur.fetchall()]
-    conn.close()
-    logger.info(f"Получено {len(users)} участников группы из БД.")
-    return users
-
-def save_user(user: types.User):
-    logger.info(f"Сохраняется пользователь: id={user.id}, username={user.username}")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, is_member) VALUES (?, ?, ?, ?, 1)",
-        (user.id, user.username, user.first_name, user.last_name)
+# === РЕЕСТР АДМИНОВ ===
+
+class AdminRegistry:
+    """Множество админов в памяти; запись в БД идет насквозь через save_admin/delete_admin."""
+
+    def __init__(self):
+        self._ids = frozenset()
+        self._data_version = None
+
+    def __contains__(self, user_id):
+        return user_id in self._ids
+
+    @property
+    def ids(self):
+        return self._ids
+
+    async def load(self):
+        self._data_version = await get_data_version()
+        self._ids = frozenset(await get_admins())
+        logger.info("Загружено %s администраторов.", len(self._ids))
+
+    def add(self, user_id):
+        self._ids = self._ids | {user_id}
+
+    def discard(self, user_id):
+        self._ids = self._ids - {user_id}
+
+    async def watch(self, interval):
+        # Для нескольких процессов: перечитываем админов, если БД менял кто-то еще
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await get_data_version() != self._data_version:
+                    await self.load()
+            except Exception as e:
+                logger.error("Ошибка синхронизации списка админов: %s", e)
+
+admin_registry = AdminRegistry()
+
+def is_admin(user_id):
+    return user_id in admin_registry
+
+async def save_admin(user_id):
+    await db_save_admin(user_id)
+    admin_registry.add(user_id)
+
+async def delete_admin(user_id):
+    await db_delete_admin(user_id)
+    admin_registry.discard(user_id)
+
+@db_task
+def get_user_id_by_username(conn, username):
+    row = conn.execute("SELECT user_id FROM users WHERE username=?", (username,)).fetchone()
+    return row[0] if row else None
+
+# Повторный /start или вход в группу снимает отметку о недоставляемости
+@db_task
+def db_save_users(conn, users):
+    # Несколько вошедших в группу одним сообщением — одной транзакцией
+    for user in users:
+        log_event("user_saved", logging.DEBUG, user_id=user.id, username=user.username)
+    conn.executemany(
+        """
+        INSERT INTO users (user_id, username, first_name, last_name, is_member) VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name,
+            is_member=1, undeliverable=NULL, undeliverable_at=NULL
+        """,
+        [(user.id, user.username, user.first_name, user.last_name) for user in users]
     )
     conn.commit()
-    conn.close()
-
-def subscribe_user(user: types.User):
-    logger.info(f"Подписка пользователя: id={user.id}, username={user.username}")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, is_member) VALUES (?, ?, ?, ?, 1)",
+
+@db_task
+def db_subscribe_user(conn, user: types.User):
+    log_event("user_subscribed", user_id=user.id, username=user.username)
+    conn.execute(
+        """
+        INSERT INTO users (user_id, username, first_name, last_name, is_member) VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name,
+            is_member=1, undeliverable=NULL, undeliverable_at=NULL
+        """,
         (user.id, user.username, user.first_name, user.last_name)
     )
     conn.commit()
-    conn.close()
 
-def unsubscribe_user(user_id):
-    logger.info(f"Отписка пользователя user_id={user_id}")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET is_member=0 WHERE user_id=?", (user_id,))
+@db_task
+def db_unsubscribe_user(conn, user_id):
+    log_event("user_unsubscribed", user_id=user_id)
+    conn.execute("UPDATE users SET is_member=0 WHERE user_id=?", (user_id,))
     conn.commit()
-    conn.close()
 
-def save_incident(text, place=None, photo_id=None, stats_msg_id=None, creator_id=None):
-    logger.info(f"Сохранение инцидента: '{text}', место: '{place}', фото: '{photo_id}', stats_msg_id: {stats_msg_id}, creator_id={creator_id}")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO incidents (text, place, photo_id, stats_msg_id, creator_id) VALUES (?, ?, ?, ?, ?)",
-        (text, place, photo_id, stats_msg_id, creator_id)
+@db_task
+def get_users(conn, user_ids):
+    rows = []
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows += conn.execute(
+            f"SELECT user_id, username, first_name FROM users WHERE user_id IN ({placeholders})", chunk
+        ).fetchall()
+    return rows
+
+# === СПРАВОЧНИК ПОЛЬЗОВАТЕЛЕЙ ===
+
+def format_user_tag(user_id, username, first_name):
+    if username:
+        return f"@{username}"
+    if first_name:
+        # Имя задает сам пользователь, а тексты уходят с ParseMode.HTML
+        return html.escape(first_name)
+    return f"id:{user_id}"
+
+class UserDirectory:
+    """LRU-кэш пользователей по user_id: (first_name, username, готовый тег)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._invalidations = 0
+
+    def _store(self, user_id, username, first_name):
+        self._entries[user_id] = (first_name, username, format_user_tag(user_id, username, first_name))
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def prime(self, user_id, username, first_name):
+        # Строки из других запросов, где пользователь уже прочитан вместе с данными
+        self._store(user_id, username, first_name)
+
+    def invalidate(self, user_id):
+        self._invalidations += 1
+        self._entries.pop(user_id, None)
+
+    async def get_many(self, user_ids):
+        result = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            entry = self._entries.get(user_id)
+            if entry is None:
+                missing.append(user_id)
+            else:
+                self._entries.move_to_end(user_id)
+                result[user_id] = entry
+        if missing:
+            invalidations = self._invalidations
+            rows = await get_users(missing)
+            # Если за время запроса кого-то поменяли, не кэшируем возможно устаревшие строки
+            cache = invalidations == self._invalidations
+            for user_id, username, first_name in rows:
+                entry = (first_name, username, format_user_tag(user_id, username, first_name))
+                result[user_id] = entry
+                if cache:
+                    self._store(user_id, username, first_name)
+            for user_id in missing:
+                if user_id not in result:
+                    result[user_id] = (None, None, f"id:{user_id}")
+                    if cache:
+                        self._store(user_id, None, None)
+        return result
+
+    async def get_tags(self, user_ids):
+        return {user_id: entry[2] for user_id, entry in (await self.get_many(user_ids)).items()}
+
+user_directory = UserDirectory(USER_CACHE_SIZE)
+
+async def save_users(users):
+    await db_save_users(users)
+    for user in users:
+        user_directory.invalidate(user.id)
+
+async def save_user(user: types.User):
+    await save_users([user])
+
+async def subscribe_user(user: types.User):
+    await db_subscribe_user(user)
+    user_directory.invalidate(user.id)
+
+async def unsubscribe_user(user_id):
+    await db_unsubscribe_user(user_id)
+    user_directory.invalidate(user_id)
+
+# === ГЕОЛОКАЦИЯ ===
+
+EARTH_RADIUS_KM = 6371.0
+
+def geo_cell(lat, lon):
+    return math.floor(lat / GEO_CELL_DEG), math.floor(lon / GEO_CELL_DEG)
+
+def haversine_km(lat, lon, lats, lons):
+    """Расстояния от точки (lat, lon) до точек lats/lons, км; с numpy — одним векторным вычислением."""
+    if np is not None:
+        lat1, lon1 = np.radians(lat), np.radians(lon)
+        lat2, lon2 = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return (2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))).tolist()
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    cos_lat1 = math.cos(lat1)
+    distances = []
+    for lat2, lon2 in zip(lats, lons):
+        lat2, lon2 = math.radians(lat2), math.radians(lon2)
+        a = math.sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        distances.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a)))
+    return distances
+
+@db_task
+def save_user_location(conn, user_id, lat, lon):
+    cell_lat, cell_lon = geo_cell(lat, lon)
+    conn.execute(
+        f"""
+        INSERT INTO user_locations (user_id, lat, lon, cell_lat, cell_lon) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            lat=excluded.lat, lon=excluded.lon, cell_lat=excluded.cell_lat, cell_lon=excluded.cell_lon,
+            updated_at={EPOCH_NOW}
+        """,
+        (user_id, lat, lon, cell_lat, cell_lon)
     )
-    i_id = cur.lastrowid
     conn.commit()
-    conn.close()
-    return i_id
-
-def set_incident_stats_msg(incident_id, stats_msg_id):
-    logger.info(f"Связываю инцидент {incident_id} с stats_msg_id={stats_msg_id}")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE incidents SET stats_msg_id=? WHERE id=?", (stats_msg_id, incident_id))
-    conn.commit()
-    conn.close()
-
-def get_incident_stats_msg_id(incident_id):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT stats_msg_id FROM incidents WHERE id=?", (incident_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row and row[0] else None
-
-def get_incident_info(incident_id):
-    conn = db_connect()
-    cur = conn.cursor()
-    # ДОБАВИЛ creator_id
-    cur.execute("SELECT text, place, photo_id, dt, creator_id FROM incidents WHERE id=?", (incident_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
 
-def save_response(incident_id, user_id, status, lat=None, lon=None):
-    logger.info(f"Сохраняется отклик: incident_id={incident_id}, user_id={user_id}, status={status}, lat={lat}, lon={lon}")
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO responses (incident_id, user_id, status, lat, lon) VALUES (?, ?, ?, ?, ?)",
-        (incident_id, user_id, status, lat, lon)
+@db_task
+def get_nearby_users(conn, lat, lon, radius_km, limit=0):
+    """Доставляемые подписчики в радиусе radius_km, от ближнего к дальнему; limit — не больше K ближайших."""
+    # Грубый отбор по ячейкам сетки через индекс, точное расстояние — haversine
+    dlat = radius_km / 111.32
+    dlon = radius_km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+    min_lat, min_lon = geo_cell(lat - dlat, lon - dlon)
+    max_lat, max_lon = geo_cell(lat + dlat, lon + dlon)
+    rows = conn.execute("""
+        SELECT l.user_id, l.lat, l.lon
+        FROM user_locations l
+        JOIN users u ON u.user_id = l.user_id
+        WHERE l.cell_lat BETWEEN ? AND ? AND l.cell_lon BETWEEN ? AND ?
+          AND u.is_member=1 AND u.undeliverable IS NULL
+    """, (min_lat, max_lat, min_lon, max_lon)).fetchall()
+    if not rows:
+        return []
+    distances = haversine_km(lat, lon, [row[1] for row in rows], [row[2] for row in rows])
+    nearby = sorted(
+        (distance, row[0]) for distance, row in zip(distances, rows) if distance <= radius_km
     )
+    if limit:
+        nearby = nearby[:limit]
+    return [user_id for _, user_id in nearby]
+
+@db_task
+def save_incident(conn, text, place=None, photo_id=None, stats_msg_id=None, creator_id=None, lat=None, lon=None):
+    logger.info("Сохранение инцидента: '%s', место: '%s', фото: '%s', stats_msg_id: %s, creator_id=%s", text, place, photo_id, stats_msg_id, creator_id)
+    cur = conn.execute(
+        "INSERT INTO incidents (text, place, photo_id, stats_msg_id, creator_id, lat, lon) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (text, place, photo_id, stats_msg_id, creator_id, lat, lon)
+    )
+    conn.commit()
+    return cur.lastrowid
+
+@db_task
+def set_incident_stats_msg(conn, incident_id, stats_msg_id):
+    logger.info("Связываю инцидент %s с stats_msg_id=%s", incident_id, stats_msg_id)
+    conn.execute("UPDATE incidents SET stats_msg_id=? WHERE id=?", (stats_msg_id, incident_id))
+    conn.commit()
+
+@db_task
+def save_responses(conn, rows):
+    # rows: [(incident_id, user_id, status, lat, lon), ...] — одной транзакцией
+    log_event("responses_flushed", count=len(rows))
+    # Upsert вместо INSERT OR REPLACE: REPLACE удаляет строку без DELETE-триггеров, и счетчики user_stats задвоились бы.
+    # Тот же статус повторно не пишется: строка, триггеры и время первого отклика остаются как были
+    changed = conn.executemany(
+        f"""
+        INSERT INTO responses (incident_id, user_id, status, lat, lon) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (incident_id, user_id) DO UPDATE SET
+            status=excluded.status, lat=excluded.lat, lon=excluded.lon, dt={EPOCH_NOW}
+        WHERE responses.status IS NOT excluded.status OR excluded.lat IS NOT NULL
+        """,
+        rows
+    ).rowcount
     conn.commit()
-    conn.close()
-
-def get_last_incident():
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT id, text, place, photo_id, dt FROM incidents ORDER BY id DESC LIMIT 1")
-    row = cur.fetchone()
-    conn.close()
-    logger.info(f"Получен последний инцидент: {row}")
+    return changed
+
+@db_task
+def get_last_incident(conn):
+    row = conn.execute("SELECT id, text, place, photo_id, dt FROM incidents ORDER BY id DESC LIMIT 1").fetchone()
+    logger.info("Получен последний инцидент: %s", row)
     return row
 
-def get_report(incident_id):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT u.first_name, u.username, r.status, r.lat, r.lon, u.user_id
+def select_missed(conn, incident_id, after_user_id=0, limit=-1, deliverable_only=False):
+    """Не ответившие из получивших рассылку; limit=-1 — все разом."""
+    # PK outbox (incident_id, user_id) + анти-джойн по PK responses, keyset по user_id
+    deliverable = "AND u.is_member=1 AND u.undeliverable IS NULL" if deliverable_only else ""
+    return conn.execute(f"""
+        SELECT o.user_id, u.username, u.first_name
+        FROM outbox o
+        JOIN users u ON u.user_id = o.user_id
+        WHERE o.incident_id=? AND o.state='sent' AND o.user_id > ? {deliverable}
+          AND NOT EXISTS (SELECT 1 FROM responses r WHERE r.incident_id=o.incident_id AND r.user_id=o.user_id)
+        ORDER BY o.user_id
+        LIMIT ?
+    """, (incident_id, after_user_id, limit)).fetchall()
+
+@db_task
+def get_report(conn, incident_id, after_user_id=0, limit=None):
+    if conn.execute("SELECT 1 FROM outbox WHERE incident_id=? LIMIT 1", (incident_id,)).fetchone():
+        return select_missed(conn, incident_id, after_user_id, limit or REPORT_PAGE_SIZE)
+    # Инциденты до outbox: все текущие участники без отклика
+    return conn.execute("""
+        SELECT u.user_id, u.username, u.first_name
+        FROM users u
+        WHERE u.is_member=1 AND u.user_id > ?
+          AND NOT EXISTS (SELECT 1 FROM responses r WHERE r.incident_id=? AND r.user_id=u.user_id)
+        ORDER BY u.user_id
+        LIMIT ?
+    """, (after_user_id, incident_id, limit or REPORT_PAGE_SIZE)).fetchall()
+
+@db_task
+def count_missed(conn, incident_id):
+    # Только для инцидентов до outbox; для остальных — счетчики incident_stats
+    return conn.execute("""
+        SELECT COUNT(*)
+        FROM users u
+        WHERE u.is_member=1
+          AND NOT EXISTS (SELECT 1 FROM responses r WHERE r.incident_id=? AND r.user_id=u.user_id)
+    """, (incident_id,)).fetchone()[0]
+
+@db_task
+def get_responders_page(conn, incident_id, after_user_id=0, limit=None):
+    return conn.execute("""
+        SELECT r.user_id, u.username, u.first_name, r.status
         FROM responses r
         JOIN users u ON u.user_id = r.user_id
-        WHERE r.incident_id=?
-    """, (incident_id,))
-    responses = cur.fetchall()
-    cur.execute("SELECT user_id, first_name, username FROM users WHERE is_member=1")
-    all_users = cur.fetchall()
-    conn.close()
-    resp_user_ids = set([r[5] for r in responses])
-    missed = [u for u in all_users if u[0] not in resp_user_ids]
-    logger.info(f"Формируется отчет: {len(responses)} ответивших, {len(missed)} не ответивших.")
-    return responses, missed
-
-def get_recent_incidents(limit=5):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT id, text, dt FROM incidents ORDER BY dt DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    conn.close()
+        WHERE r.incident_id=? AND r.user_id > ?
+        ORDER BY r.user_id
+        LIMIT ?
+    """, (incident_id, after_user_id, limit or REPORT_PAGE_SIZE)).fetchall()
+
+@db_task
+def get_recent_incidents(conn, limit=5):
+    rows = conn.execute("SELECT id, text, dt FROM incidents ORDER BY dt DESC LIMIT ?", (limit,)).fetchall()
     incidents = []
     for row in rows:
         incident_id, text, dt = row
@@ -251,70 +1154,1269 @@ def get_recent_incidents(limit=5):
         })
     return incidents
 
-def get_go_members(incident_id):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT u.first_name, u.username, u.user_id
-        FROM responses r
-        JOIN users u ON u.user_id = r.user_id
-        WHERE r.incident_id=? AND r.status='Пойду'
-    """, (incident_id,))
-    rows = cur.fetchall()
-    conn.close()
-    tags = []
-    for fname, username, user_id in rows:
-        if username:
-            tags.append(f"@{username}")
-        else:
-            tags.append(f"id:{user_id}")
-    return tags
-
-def get_user_tag(user_id):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT username, first_name FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        username, first_name = row
-        if username:
-            return f"@{username}"
-        elif first_name:
-            return first_name
-    return f"id:{user_id}"
+# === СТАТИСТИКА ОТКЛИКОВ ===
+
+USER_STATS_COLUMNS = "s.user_id, u.username, u.first_name, s.notified, s.go_count, s.no_count, s.median_delay, s.last_response_at"
+
+@db_task
+def get_user_stats(conn, user_id):
+    return conn.execute(f"""
+        SELECT {USER_STATS_COLUMNS}
+        FROM user_stats s LEFT JOIN users u ON u.user_id = s.user_id
+        WHERE s.user_id=?
+    """, (user_id,)).fetchone()
+
+@db_task
+def get_top_user_stats(conn, limit):
+    # По индексу idx_user_stats_score, без сортировки всех пользователей
+    return conn.execute(f"""
+        SELECT {USER_STATS_COLUMNS}
+        FROM user_stats s LEFT JOIN users u ON u.user_id = s.user_id
+        WHERE s.notified > 0
+        ORDER BY s.score DESC
+        LIMIT ?
+    """, (limit,)).fetchall()
+
+@db_task
+def get_stats_totals(conn):
+    return conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(notified), 0), COALESCE(SUM(go_count), 0), COALESCE(SUM(no_count), 0) FROM incident_stats"
+    ).fetchone()
+
+def format_duration(seconds):
+    if seconds is None:
+        return "нет данных"
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+def format_user_stats(row):
+    user_id, username, first_name, notified, go_count, no_count, median_delay, last_response_at = row
+    # notified может отставать от откликов на инциденты до outbox
+    delivered = max(notified, go_count + no_count)
+    go_rate = go_count / delivered * 100 if delivered else 0
+    text = (
+        f"{format_user_tag(user_id, username, first_name)}: доставлено {delivered}, "
+        f"пойду {go_count} ({go_rate:.0f}%), не могу {no_count}, медиана отклика {format_duration(median_delay)}"
+    )
+    if last_response_at:
+        text += f", последний отклик {utc_to_msk(last_response_at)}"
+    return text
+
+# === СНИМОК ИНЦИДЕНТА ===
+
+@dataclass
+class IncidentSnapshot:
+    """Все, что нужно для статистики и отчета по инциденту; состояние читается одной транзакцией."""
+    incident_id: int
+    text: str
+    place: str
+    photo_id: str
+    dt: int
+    creator_id: int
+    creator_tag: str
+    stats_msg_id: int
+    go_count: int
+    no_count: int
+    notified: int  # доставлено через outbox (0 — инцидент до outbox)
+    go: list  # теги первых STATS_LIST_LIMIT ответивших "Пойду" (пусто, если снимок без списков)
+
+    @property
+    def missed_count(self):
+        return max(self.notified - self.go_count - self.no_count, 0)
+
+@db_task
+def read_incident_snapshot(conn, incident_id, with_lists):
+    conn.execute("BEGIN")
+    try:
+        # Счетчики — готовые из incident_stats, без подсчета строк responses
+        row = conn.execute("""
+            SELECT i.text, i.place, i.photo_id, i.dt, i.creator_id, i.stats_msg_id,
+                   COALESCE(s.go_count, 0), COALESCE(s.no_count, 0), COALESCE(s.notified, 0)
+            FROM incidents i LEFT JOIN incident_stats s ON s.incident_id = i.id
+            WHERE i.id=?
+        """, (incident_id,)).fetchone()
+        if not row:
+            return None, []
+        go_ids = []
+        if with_lists:
+            # Только нужная часть списка, по индексу (incident_id, status, user_id)
+            go_ids = [r[0] for r in conn.execute(
+                "SELECT user_id FROM responses WHERE incident_id=? AND status='Пойду' LIMIT ?",
+                (incident_id, STATS_LIST_LIMIT)
+            )]
+    finally:
+        conn.commit()
+    return row, go_ids
+
+async def get_incident_snapshot(incident_id, with_lists=True):
+    row, go_ids = await read_incident_snapshot(incident_id, with_lists)
+    if not row:
+        return None
+    text, place, photo_id, dt, creator_id, stats_msg_id, go_count, no_count, notified = row
+    # Теги создателя и откликнувшихся — одним запросом к справочнику (обычно из кэша)
+    tags = await user_directory.get_tags(go_ids + ([creator_id] if creator_id else []))
+    creator_tag = tags[creator_id] if creator_id else "Неизвестен"
+    return IncidentSnapshot(
+        incident_id=incident_id, text=text, place=place, photo_id=photo_id, dt=dt,
+        creator_id=creator_id, creator_tag=creator_tag, stats_msg_id=stats_msg_id or None,
+        go_count=go_count, no_count=no_count, notified=notified, go=[tags[user_id] for user_id in go_ids]
+    )
 
-def get_incident_stats_text(incident_id):
-    info = get_incident_info(incident_id)
-    if not info:
+def render_stats_text(snap):
+    if not snap:
         return "Инцидент не найден."
-    description, place, photo_id, dt, creator_id = info
-    dt_str = utc_to_msk(dt)
-    # Добавляем тег создателя
-    creator_tag = get_user_tag(creator_id) if creator_id else "Неизвестен"
-    text = f"<b>Инцидент:</b> {description}\n<b>Создатель:</b> {creator_tag}"
-    if place:
-        text += f"\n<b>Место сбора:</b> {place}"
-    text += f"\n<b>Время:</b> {dt_str}\n"
-    go_members = get_go_members(incident_id)
-    if go_members:
-        text += "\n<b>Пойдут:</b>\n"
-        for tag in go_members:
-            text += f" - {tag}\n"
+    text = f"<b>Инцидент:</b> {snap.text}\n<b>Создатель:</b> {snap.creator_tag}"
+    if snap.place:
+        text += f"\n<b>Место сбора:</b> {snap.place}"
+    text += f"\n<b>Время:</b> {utc_to_msk(snap.dt)}\n"
+    if snap.go_count:
+        text += f"\n<b>Пойдут ({snap.go_count}):</b>\n"
+        # Список обрезается так, чтобы закреп влез в лимит Telegram
+        limit = (CAPTION_LIMIT if snap.photo_id else TEXT_LIMIT) - 40
+        shown = 0
+        for tag in snap.go:
+            line = f" - {tag}\n"
+            if len(text) + len(line) > limit:
+                break
+            text += line
+            shown += 1
+        if snap.go_count > shown:
+            text += f" ...и еще {snap.go_count - shown}\n"
     else:
         text += "\n<b>Пойдут:</b> пока никто не откликнулся"
     return text
 
+# === РАССЫЛКА ===
+
+class TokenBucket:
+    """Глобальный лимит отправки: не больше rate сообщений в секунду."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        # Telegram прислал 429 — останавливаем всю рассылку на retry_after
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ChatRateLimiter:
+    """Лимит на один чат: не чаще одного сообщения в interval секунд."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_slot = {}  # chat_id: monotonic-время следующей разрешенной отправки
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if len(self._next_slot) > 10000:
+            self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+        slot = max(now, self._next_slot.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+send_bucket = TokenBucket(BROADCAST_RATE)
+chat_limiter = ChatRateLimiter(PER_CHAT_INTERVAL)
+
+async def send_limited(chat_id, send):
+    """Выполняет send() с учетом глобального и per-chat лимитов, повторяя при 429."""
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        await chat_limiter.acquire(chat_id)
+        await send_bucket.acquire()
+        started = time.perf_counter()
+        try:
+            return await send()
+        except TelegramRetryAfter as e:
+            RETRY_AFTER.inc()
+            if attempt >= SEND_MAX_RETRIES:
+                raise
+            log_event("rate_limited", logging.WARNING, chat_id=chat_id, retry_after=e.retry_after, attempt=attempt + 1)
+            send_bucket.pause(e.retry_after)
+            await asyncio.sleep(e.retry_after)
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - started)
+
+@dataclass
+class BroadcastResult:
+    sent: int = 0
+    failed: int = 0
+    elapsed: float = 0.0  # секунд от начала рассылки до последней доставки
+
+async def broadcast(recipients, send_one, concurrency=BROADCAST_CONCURRENCY, on_done=None):
+    """Рассылает send_one(uid) всем recipients пулом из concurrency воркеров.
+
+    on_done(uid, sent_message, error) вызывается после каждой попытки доставки.
+    """
+    recipients = list(recipients)
+    result = BroadcastResult()
+    started = time.monotonic()
+    pending = iter(recipients)
+
+    async def worker():
+        for uid in pending:
+            try:
+                sent_message = await send_limited(uid, lambda: send_one(uid))
+                result.sent += 1
+                result.elapsed = time.monotonic() - started
+                if on_done:
+                    on_done(uid, sent_message, None)
+            except Exception as e:
+                result.failed += 1
+                SEND_FAILURES.inc(reason=classify_send_error(e))
+                log_event("send_failed", logging.WARNING, user_id=uid, error=str(e))
+                if on_done:
+                    on_done(uid, None, e)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(recipients)))))
+    BROADCAST_SECONDS.observe(time.monotonic() - started)
+    # Одна сводка на рассылку вместо строки на каждого получателя
+    log_event(
+        "broadcast_done", recipients=len(recipients), sent=result.sent, failed=result.failed,
+        elapsed_s=round(result.elapsed, 3)
+    )
+    return result
+
+# === ОЧЕРЕДЬ РАССЫЛКИ (OUTBOX) ===
+# Каждая рассылка сначала записывается в outbox, затем воркеры забирают строки пачками.
+# Захват — один UPDATE ... RETURNING, поэтому разбирать outbox могут несколько процессов
+# (лимит BROADCAST_RATE действует на процесс — делите его между процессами).
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+@db_task
+def outbox_enqueue(conn, incident_id, nearby=None, nearby_only=False, tiers=BROADCAST_TIERS):
+    # priority: ближайшие (nearby) — 0, остальные — ярусы по user_stats.score, самые отзывчивые раньше
+    count = 0
+    if nearby:
+        count += conn.executemany(
+            "INSERT OR IGNORE INTO outbox (incident_id, user_id, priority) VALUES (?, ?, 0)",
+            [(incident_id, user_id) for user_id in nearby]
+        ).rowcount
+    if not nearby_only:
+        count += conn.execute("""
+            INSERT OR IGNORE INTO outbox (incident_id, user_id, priority)
+            SELECT ?, u.user_id, ? + NTILE(?) OVER (ORDER BY COALESCE(s.score, ?) DESC) - 1
+            FROM users u LEFT JOIN user_stats s ON s.user_id = u.user_id
+            WHERE u.is_member=1 AND u.undeliverable IS NULL
+        """, (incident_id, 1 if nearby else 0, max(tiers, 1), NEW_USER_SCORE)).rowcount
+    conn.commit()
+    return count
+
+@db_task
+def outbox_claim(conn, incident_id, worker_id, limit):
+    rows = conn.execute("""
+        UPDATE outbox
+        SET state='sending', claimed_by=?, claimed_at=CAST(strftime('%s', 'now') AS INTEGER), attempts=attempts+1
+        WHERE rowid IN (
+            SELECT rowid FROM outbox WHERE state='pending' AND incident_id=? ORDER BY priority LIMIT ?
+        )
+        RETURNING user_id, attempts, priority
+    """, (worker_id, incident_id, limit)).fetchall()
+    conn.commit()
+    return rows
+
+@db_task
+def outbox_finish(conn, rows, undeliverable):
+    # rows: [(state, message_id, sent_at, error, incident_id, user_id), ...]
+    # undeliverable: [(kind, user_id), ...], kind — 'blocked' / 'not_found'
+    conn.executemany(f"""
+        UPDATE outbox SET state=?, message_id=?, sent_at=?, error=?, claimed_by=NULL, updated_at={EPOCH_NOW}
+        WHERE incident_id=? AND user_id=?
+    """, rows)
+    conn.executemany(f"UPDATE users SET undeliverable=?, undeliverable_at={EPOCH_NOW} WHERE user_id=?", undeliverable)
+    conn.commit()
+
+def classify_send_error(error):
+    """Причина недоставки: 'blocked' и 'not_found' — постоянные, 'transient' — стоит повторить."""
+    if isinstance(error, TelegramForbiddenError):
+        return "blocked"
+    if isinstance(error, TelegramBadRequest):
+        description = str(error).lower()
+        if "chat not found" in description or "user not found" in description or "deactivated" in description:
+            return "not_found"
+    return "transient"
+
+@db_task
+def outbox_touch(conn, incident_id, worker_id):
+    # Пачка еще рассылается: продлеваем захват, чтобы outbox_release_stale не вернул ее в pending
+    conn.execute(
+        "UPDATE outbox SET claimed_at=CAST(strftime('%s', 'now') AS INTEGER) "
+        "WHERE state='sending' AND incident_id=? AND claimed_by=?",
+        (incident_id, worker_id)
+    )
+    conn.commit()
+
+@db_task
+def outbox_release_stale(conn, timeout):
+    cur = conn.execute("""
+        UPDATE outbox SET state='pending', claimed_by=NULL
+        WHERE state='sending' AND claimed_at < CAST(strftime('%s', 'now') AS INTEGER) - ?
+    """, (timeout,))
+    conn.commit()
+    return cur.rowcount
+
+@db_task
+def outbox_pending_incidents(conn):
+    return [row[0] for row in conn.execute("SELECT DISTINCT incident_id FROM outbox WHERE state='pending'")]
+
+@db_task
+def get_outbox_counts(conn, incident_id):
+    counts = dict(conn.execute(
+        "SELECT state, COUNT(*) FROM outbox WHERE incident_id=? GROUP BY state", (incident_id,)
+    ).fetchall())
+    return {state: counts.get(state, 0) for state in ("pending", "sending", "sent", "failed")}
+
+@db_task
+def get_alert(conn, incident_id):
+    return conn.execute("SELECT text, place, photo_id FROM incidents WHERE id=?", (incident_id,)).fetchone()
+
+def format_alert(text, place):
+    alert_text = f"<b>Экстренное сообщение:</b>\n{text}"
+    if place:
+        alert_text += f"\n\n<b>Место сбора:</b> {place}"
+    return alert_text
+
+def alert_markup(incident_id):
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="Пойду", callback_data=f"go_{incident_id}"),
+        InlineKeyboardButton(text="Не могу", callback_data=f"no_{incident_id}")
+    )
+    return builder.as_markup()
+
+class Outbox:
+    """Разбор outbox: захват пачек, отправка через broadcast, фиксация результата."""
+
+    def __init__(self, worker_id, batch_size):
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+
+    async def drain(self, incident_id):
+        alert = await get_alert(incident_id)
+        if not alert:
+            return BroadcastResult()
+        text, place, photo = alert
+        notify_text = format_alert(text, place)
+        markup = alert_markup(incident_id)
+
+        async def send_alert(uid):
+            if photo:
+                return await bot.send_photo(uid, photo=photo, caption=notify_text, reply_markup=markup)
+            return await bot.send_message(uid, notify_text, reply_markup=markup)
+
+        total = BroadcastResult()
+        started = time.monotonic()
+        while True:
+            claimed = await outbox_claim(incident_id, self.worker_id, self.batch_size)
+            if not claimed:
+                counts = await get_outbox_counts(incident_id)
+                if not counts["pending"] and not counts["sending"]:
+                    break
+                # Остаток держат другие воркеры; брошенные захваты вернутся в pending по таймауту
+                await outbox_release_stale(OUTBOX_CLAIM_TIMEOUT)
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+                continue
+            # Порядок RETURNING не определен — внутри пачки тоже идем от высшего яруса
+            attempts = {uid: attempt for uid, attempt, _ in sorted(claimed, key=lambda row: row[2])}
+            finished = []
+            undeliverable = []
+
+            def on_done(uid, sent_message, error):
+                if error is None:
+                    # Момент доставки именно этому получателю, а не конец пачки
+                    finished.append(("sent", sent_message.message_id, int(time.time()), None, incident_id, uid))
+                    return
+                kind = classify_send_error(error)
+                if kind != "transient":
+                    log_event("recipient_undeliverable", logging.WARNING, user_id=uid, reason=kind)
+                    undeliverable.append((kind, uid))
+                    state = "failed"
+                else:
+                    state = "failed" if attempts[uid] >= OUTBOX_MAX_ATTEMPTS else "pending"
+                finished.append((state, None, None, f"{kind}: {error}"[:200], incident_id, uid))
+
+            batch_started = time.monotonic()
+            heartbeat = asyncio.create_task(self._heartbeat(incident_id))
+            try:
+                result = await broadcast(attempts, send_alert, on_done=on_done)
+            finally:
+                heartbeat.cancel()
+            await outbox_finish(finished, undeliverable)
+            # Пачка уходила, пока инцидент закрывали: эти сообщения /close уже не увидел
+            if result.sent and await is_incident_closed(incident_id):
+                await recall_alerts(incident_id)
+            total.sent += result.sent
+            total.failed += result.failed
+            if result.sent:
+                total.elapsed = batch_started - started + result.elapsed
+        return total
+
+    async def _heartbeat(self, incident_id):
+        # Пачка может идти дольше таймаута (общий лимитер, длинный retry_after) — продлеваем захват заранее
+        while True:
+            await asyncio.sleep(OUTBOX_CLAIM_TIMEOUT / 3)
+            try:
+                await outbox_touch(incident_id, self.worker_id)
+            except Exception as e:
+                logger.error("Не удалось продлить захват outbox по инциденту %s: %s", incident_id, e)
+
+    async def run(self):
+        # Дорассылка после рестарта и помощь другим процессам
+        while True:
+            try:
+                await outbox_release_stale(OUTBOX_CLAIM_TIMEOUT)
+                for incident_id in await outbox_pending_incidents():
+                    logger.info("Продолжаю рассылку по инциденту %s из outbox", incident_id)
+                    await self.drain(incident_id)
+            except Exception as e:
+                logger.error("Ошибка разбора outbox: %s", e)
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+outbox = Outbox(WORKER_ID, OUTBOX_BATCH_SIZE)
+
+# === НАПОМИНАНИЯ НЕ ОТВЕТИВШИМ ===
+# Все таймеры — в одной куче (due_at, incident_id, round) и в таблице followups;
+# одна задача спит до ближайшего срока, новые инциденты будят ее через Event.
+
+@db_task
+def schedule_followups(conn, incident_id, minutes):
+    conn.executemany(
+        "INSERT OR IGNORE INTO followups (incident_id, round, due_at) SELECT id, ?, dt + ? FROM incidents WHERE id=?",
+        [(number, offset * 60, incident_id) for number, offset in enumerate(minutes, start=1)]
+    )
+    conn.commit()
+    return conn.execute(
+        "SELECT due_at, incident_id, round FROM followups WHERE incident_id=? AND started_at IS NULL", (incident_id,)
+    ).fetchall()
+
+@db_task
+def load_followups(conn):
+    return conn.execute("SELECT due_at, incident_id, round FROM followups WHERE started_at IS NULL").fetchall()
+
+@db_task
+def start_followup(conn, incident_id, round_number):
+    """Берет раунд и возвращает его получателей; None — раунд уже взят или поглощен следующим."""
+    claimed = conn.execute(
+        f"UPDATE followups SET started_at={EPOCH_NOW} WHERE incident_id=? AND round=? AND started_at IS NULL",
+        (incident_id, round_number)
+    ).rowcount
+    conn.commit()
+    if not claimed:
+        return None
+    # Бот лежал дольше интервала между раундами: вместо двух напоминаний подряд — только последнее
+    if conn.execute(
+        f"SELECT 1 FROM followups WHERE incident_id=? AND round>? AND due_at<={EPOCH_NOW} AND started_at IS NULL",
+        (incident_id, round_number)
+    ).fetchone():
+        return []
+    return [row[0] for row in select_missed(conn, incident_id, deliverable_only=True)]
+
+@db_task
+def finish_followup(conn, incident_id, round_number, sent, failed, messages):
+    # messages: [(user_id, message_id), ...] — для отзыва по /close
+    conn.execute(
+        "UPDATE followups SET sent=?, failed=? WHERE incident_id=? AND round=?",
+        (sent, failed, incident_id, round_number)
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO followup_messages (incident_id, round, user_id, message_id) VALUES (?, ?, ?, ?)",
+        [(incident_id, round_number, user_id, message_id) for user_id, message_id in messages]
+    )
+    conn.commit()
+
+class FollowUpScheduler:
+    """Повторно оповещает не ответивших через заданные минуты после инцидента."""
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def load(self):
+        self._heap = await load_followups()
+        heapq.heapify(self._heap)
+        if self._heap:
+            logger.info("Загружено %s отложенных напоминаний", len(self._heap))
+
+    async def schedule(self, incident_id):
+        if not self.minutes:
+            return
+        for timer in await schedule_followups(incident_id, self.minutes):
+            heapq.heappush(self._heap, timer)
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, incident_id, round_number = heapq.heappop(self._heap)
+            try:
+                await self._fire(incident_id, round_number)
+            except Exception as e:
+                logger.error("Ошибка напоминания по инциденту %s (раунд %s): %s", incident_id, round_number, e)
+
+    async def _fire(self, incident_id, round_number):
+        targets = await start_followup(incident_id, round_number)
+        if not targets:
+            return
+        alert = await get_alert(incident_id)
+        if not alert:
+            return
+        text, place, _ = alert
+        reminder = f"<b>Напоминание:</b> вы еще не ответили.\n\n{format_alert(text, place)}"
+        markup = alert_markup(incident_id)
+        undeliverable = []
+        messages = []
+
+        def on_done(uid, sent_message, error):
+            if error is None:
+                messages.append((uid, sent_message.message_id))
+                return
+            kind = classify_send_error(error)
+            if kind != "transient":
+                undeliverable.append((kind, uid))
+
+        result = await broadcast(targets, lambda uid: bot.send_message(uid, reminder, reply_markup=markup), on_done=on_done)
+        # Недоставляемые помечаются так же, как при основной рассылке
+        await outbox_finish([], undeliverable)
+        await finish_followup(incident_id, round_number, result.sent, result.failed, messages)
+        if result.sent and await is_incident_closed(incident_id):
+            await recall_alerts(incident_id)
+        log_event("followup_done", incident_id=incident_id, round=round_number, sent=result.sent, failed=result.failed)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+followups = FollowUpScheduler(FOLLOWUP_MINUTES)
+
+# === ЗАКРЫТИЕ ИНЦИДЕНТА ===
+
+CLOSED_NOTE = "<b>Инцидент закрыт, отклики больше не принимаются.</b>"
+
+@db_task
+def get_closed_incident_ids(conn):
+    return [row[0] for row in conn.execute("SELECT id FROM incidents WHERE closed_at IS NOT NULL")]
+
+@db_task
+def close_incident(conn, incident_id, delete=False):
+    """Помечает инцидент закрытым; False — уже закрыт (например, другим процессом)."""
+    closed = conn.execute(
+        f"UPDATE incidents SET closed_at={EPOCH_NOW}, recall_delete=? WHERE id=? AND closed_at IS NULL",
+        (int(delete), incident_id)
+    ).rowcount
+    if closed:
+        # Недоотправленные оповещения и оставшиеся напоминания больше не нужны;
+        # строки в sending дошлет их воркер и сам отзовет (см. Outbox.drain)
+        conn.execute(
+            f"UPDATE outbox SET state='failed', error='closed', updated_at={EPOCH_NOW} WHERE incident_id=? AND state='pending'",
+            (incident_id,)
+        )
+        conn.execute(f"UPDATE followups SET started_at={EPOCH_NOW} WHERE incident_id=? AND started_at IS NULL", (incident_id,))
+    conn.commit()
+    return bool(closed)
+
+@db_task
+def is_incident_closed(conn, incident_id):
+    return conn.execute(
+        "SELECT 1 FROM incidents WHERE id=? AND closed_at IS NOT NULL", (incident_id,)
+    ).fetchone() is not None
+
+@db_task
+def get_recall(conn, incident_id):
+    return conn.execute(
+        "SELECT text, place, photo_id, recall_delete FROM incidents WHERE id=?", (incident_id,)
+    ).fetchone()
+
+@db_task
+def get_reminder_rounds(conn, incident_id):
+    return [row[0] for row in conn.execute(
+        "SELECT DISTINCT round FROM followup_messages WHERE incident_id=? ORDER BY round", (incident_id,)
+    )]
+
+@db_task
+def claim_recall(conn, incident_id, round_number, after_user_id, limit):
+    """Забирает на отзыв доставленные сообщения закрытого инцидента: [(user_id, message_id), ...].
+
+    Каждое сообщение забирается один раз — и /close, и рассылка, закончившая пачку после закрытия,
+    отзывают только то, что забрали сами.
+    """
+    # round 0 — основное оповещение из outbox, остальные — напоминания; keyset по user_id (строка на получателя)
+    if round_number == 0:
+        table, delivered = "outbox", "state='sent' AND message_id IS NOT NULL"
+    else:
+        table, delivered = "followup_messages", "round=?2"
+    rows = conn.execute(f"""
+        UPDATE {table} SET recalled_at={EPOCH_NOW}
+        WHERE rowid IN (
+            SELECT rowid FROM {table}
+            WHERE incident_id=?1 AND {delivered} AND recalled_at IS NULL AND user_id > ?3
+            ORDER BY user_id LIMIT ?4
+        ) AND EXISTS (SELECT 1 FROM incidents WHERE id=?1 AND closed_at IS NOT NULL)
+        RETURNING user_id, message_id
+    """, (incident_id, round_number, after_user_id, limit)).fetchall()
+    conn.commit()
+    return rows
+
+class ClosedIncidents:
+    """Закрытые инциденты в памяти: поздний колбэк отклоняется без обращения к БД."""
+
+    def __init__(self):
+        self._ids = set()
+        self._data_version = None
+
+    def __contains__(self, incident_id):
+        return incident_id in self._ids
+
+    async def load(self):
+        self._data_version = await get_data_version()
+        self._ids = set(await get_closed_incident_ids())
+
+    def add(self, incident_id):
+        self._ids.add(incident_id)
+
+    async def watch(self, interval):
+        # Как у AdminRegistry: инцидент мог закрыть другой процесс
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await get_data_version() != self._data_version:
+                    await self.load()
+            except Exception as e:
+                logger.error("Ошибка синхронизации закрытых инцидентов: %s", e)
+
+closed_incidents = ClosedIncidents()
+
+async def recall_alerts(incident_id, batch_size=OUTBOX_BATCH_SIZE):
+    """Правит (или удаляет) оповещения и напоминания закрытого инцидента через общий лимитер рассылки."""
+    total = BroadcastResult()
+    recall = await get_recall(incident_id)
+    if not recall:
+        return total
+    text, place, photo, delete = recall
+    closed_text = f"{format_alert(text, place)}\n\n{CLOSED_NOTE}"
+    # Подпись к фото ограничена: если пометка не помещается, только убираем кнопки
+    caption_fits = len(closed_text) <= CAPTION_LIMIT
+    for round_number in [0, *await get_reminder_rounds(incident_id)]:
+        # Напоминание — всегда текст, фото бывает только у основного оповещения
+        with_photo = photo and round_number == 0
+        after = 0
+        while True:
+            rows = await claim_recall(incident_id, round_number, after, batch_size)
+            if not rows:
+                break
+            after = max(user_id for user_id, _ in rows)
+            message_ids = dict(rows)
+
+            async def recall_one(uid):
+                message_id = message_ids[uid]
+                if delete:
+                    return await bot.delete_message(uid, message_id)
+                if not with_photo:
+                    return await bot.edit_message_text(closed_text, chat_id=uid, message_id=message_id)
+                if caption_fits:
+                    return await bot.edit_message_caption(chat_id=uid, message_id=message_id, caption=closed_text)
+                return await bot.edit_message_reply_markup(chat_id=uid, message_id=message_id, reply_markup=None)
+
+            result = await broadcast(message_ids, recall_one)
+            total.sent += result.sent
+            total.failed += result.failed
+    return total
+
+# === СВЕРКА УЧАСТНИКОВ ГРУППЫ ===
+# Вход/выход в группу бот видит только по служебным сообщениям; пропущенные выходы исправляет /sync_members.
+# is_member=0 означает и "вышел из группы", и отписку через /stop, поэтому сверка только снимает
+# is_member (1 -> 0) и никогда не возвращает его: иначе она подписала бы обратно всех отписавшихся.
+
+@db_task
+def count_members(conn):
+    return conn.execute("SELECT COUNT(*) FROM users WHERE is_member=1").fetchone()[0]
+
+@db_task
+def get_membership_page(conn, after_user_id, limit):
+    # idx_users_member (is_member, user_id): keyset по участникам без обхода отписавшихся
+    return [row[0] for row in conn.execute(
+        "SELECT user_id FROM users WHERE is_member=1 AND user_id > ? ORDER BY user_id LIMIT ?", (after_user_id, limit)
+    )]
+
+@db_task
+def apply_membership(conn, members, gone):
+    # members: [(user_id, username, first_name, last_name), ...] — все еще в группе, обновляем имена
+    # gone: [(user_id,), ...] — вышли из группы или Telegram их не знает
+    conn.executemany("""
+        UPDATE users SET username=?2, first_name=?3, last_name=?4
+        WHERE user_id=?1 AND (username IS NOT ?2 OR first_name IS NOT ?3 OR last_name IS NOT ?4)
+    """, members)
+    conn.executemany("UPDATE users SET is_member=0 WHERE user_id=? AND is_member<>0", gone)
+    conn.commit()
+
+def is_group_member(member):
+    if member.status in ("creator", "administrator", "member"):
+        return True
+    return member.status == "restricted" and member.is_member
+
+class MemberSync:
+    """Снимает is_member с вышедших из группы по get_chat_member: пачками, с ограниченной конкурентностью и своим лимитом."""
+
+    def __init__(self, concurrency, rate, batch_size):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        # Отдельная корзина: сверка не должна отнимать лимит у экстренной рассылки
+        self.bucket = TokenBucket(rate)
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, progress_message):
+        self.task = asyncio.create_task(self._run(progress_message))
+
+    async def _check(self, user_id):
+        """(user_id, ChatMember) — участник найден, (user_id, None) — Telegram его не знает, None — ошибка."""
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                return user_id, await bot.get_chat_member(GROUP_CHAT_ID, user_id)
+            except TelegramRetryAfter as e:
+                RETRY_AFTER.inc()
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                description = str(e).lower()
+                if "user not found" in description or "participant_id_invalid" in description:
+                    return user_id, None
+                log_event("member_check_failed", logging.WARNING, user_id=user_id, error=str(e))
+                return None
+            except Exception as e:
+                log_event("member_check_failed", logging.WARNING, user_id=user_id, error=str(e))
+                return None
+        return None
+
+    async def _check_page(self, user_ids):
+        results = []
+        pending = iter(user_ids)
+
+        async def worker():
+            for user_id in pending:
+                result = await self._check(user_id)
+                if result is not None:
+                    results.append(result)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(user_ids)))))
+        return results
+
+    async def _run(self, progress_message):
+        started = time.monotonic()
+        total = await count_members()
+        checked = left = errors = 0
+        after_user_id = 0
+        last_progress = started
+
+        async def report(text):
+            try:
+                await progress_message.edit_text(text)
+            except TelegramBadRequest:
+                pass
+
+        try:
+            while True:
+                page = await get_membership_page(after_user_id, self.batch_size)
+                if not page:
+                    break
+                after_user_id = page[-1]
+                members, gone = [], []
+                for user_id, member in await self._check_page(page):
+                    if member is not None and is_group_member(member):
+                        user = member.user
+                        members.append((user_id, user.username, user.first_name, user.last_name))
+                    else:
+                        gone.append((user_id,))
+                left += len(gone)
+                errors += len(page) - len(members) - len(gone)
+                await apply_membership(members, gone)
+                for user_id in page:
+                    user_directory.invalidate(user_id)
+                checked += len(page)
+                if time.monotonic() - last_progress >= SYNC_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await report(f"Сверка участников: проверено {checked} из {total}...")
+        except asyncio.CancelledError:
+            await report(f"Сверка участников прервана: проверено {checked} из {total}.")
+            raise
+        except Exception as e:
+            logger.error("Ошибка сверки участников: %s", e)
+            await report(f"Сверка участников остановлена из-за ошибки после {checked} из {total}: {e}")
+            return
+        elapsed = time.monotonic() - started
+        log_event("members_synced", checked=checked, left=left, errors=errors, elapsed_s=round(elapsed, 1))
+        await report(
+            f"Сверка участников завершена за {elapsed:.0f} с: проверено {checked}, "
+            f"вышли из группы {left}, ошибок {errors}.\n"
+            "Отписавшиеся от рассылки не проверяются и остаются отписанными. "
+            "Участников, которые ни разу не писали боту и не входили при нем в группу, Telegram не показывает."
+        )
+
+    async def close(self):
+        if self.running:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+member_sync = MemberSync(SYNC_CONCURRENCY, SYNC_RATE, SYNC_BATCH_SIZE)
+
+# === ОБНОВЛЕНИЕ ЗАКРЕПЛЕННОЙ СТАТИСТИКИ ===
+
+class StatsUpdater:
+    """Объединяет обновления закрепленного сообщения: не больше одной правки в interval секунд на инцидент."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._dirty = set()
+        self._tasks = {}       # incident_id: задача, которая сбросит обновление
+        self._last_flush = {}  # incident_id: monotonic-время последней правки
+        self._last_text = {}   # incident_id: последний отправленный текст
+
+    def remember(self, incident_id, text):
+        self._last_text[incident_id] = text
+
+    def mark_dirty(self, incident_id):
+        self._dirty.add(incident_id)
+        if incident_id not in self._tasks:
+            self._tasks[incident_id] = asyncio.create_task(self._run(incident_id))
+
+    async def _run(self, incident_id):
+        try:
+            while incident_id in self._dirty:
+                delay = self._last_flush.get(incident_id, 0.0) + self.interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._dirty.discard(incident_id)
+                await self._flush(incident_id)
+        finally:
+            self._tasks.pop(incident_id, None)
+
+    async def _flush(self, incident_id):
+        self._last_flush[incident_id] = time.monotonic()
+        snap = await get_incident_snapshot(incident_id)
+        if not snap or not snap.stats_msg_id:
+            return
+        stats_msg_id = snap.stats_msg_id
+        stats_text = render_stats_text(snap)
+        if self._last_text.get(incident_id) == stats_text:
+            return
+        try:
+            if snap.photo_id:
+                await bot.edit_message_caption(
+                    chat_id=GROUP_CHAT_ID,
+                    message_id=stats_msg_id,
+                    caption=stats_text,
+                    parse_mode=ParseMode.HTML
+                )
+            else:
+                await bot.edit_message_text(
+                    chat_id=GROUP_CHAT_ID,
+                    message_id=stats_msg_id,
+                    text=stats_text,
+                    parse_mode=ParseMode.HTML
+                )
+            self._last_text[incident_id] = stats_text
+            log_event("stats_updated", incident_id=incident_id, msg_id=stats_msg_id, go=snap.go_count)
+        except TelegramRetryAfter as e:
+            log_event("rate_limited", logging.WARNING, incident_id=incident_id, retry_after=e.retry_after)
+            self._last_flush[incident_id] = time.monotonic() + e.retry_after
+            self._dirty.add(incident_id)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self._last_text[incident_id] = stats_text
+            else:
+                logger.error("Ошибка обновления статистики по инциденту %s group_id=%s: %s", incident_id, GROUP_CHAT_ID, e)
+        except Exception as e:
+            logger.error("Ошибка обновления статистики по инциденту %s group_id=%s: %s", incident_id, GROUP_CHAT_ID, e)
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        # Сбрасываем последнее состояние, чтобы закреп не остался устаревшим
+        for incident_id in list(self._dirty):
+            self._dirty.discard(incident_id)
+            await self._flush(incident_id)
+
+stats_updater = StatsUpdater(STATS_UPDATE_INTERVAL)
+
+# === БУФЕР ОТКЛИКОВ ===
+
+class ResponseWriter:
+    """Колбэки кладут отклики в очередь, фоновая задача пишет их пачками одной транзакцией."""
+
+    def __init__(self, batch_size, flush_interval, maxsize):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, incident_id, user_id, status, lat=None, lon=None):
+        # Очередь ограничена: если запись отстает, колбэк подождет здесь
+        await self._queue.put((incident_id, user_id, status, lat, lon))
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if batch[0] is not None and self._queue.qsize() < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            stop = None in batch
+            rows = [row for row in batch if row is not None]
+            if rows:
+                await self._flush(rows)
+            if stop:
+                return
+
+    async def _flush(self, rows):
+        # Несколько откликов одного пользователя в пачке: в силе последний
+        rows = list({(row[0], row[1]): row for row in rows}.values())
+        delay = 0.1
+        while True:
+            try:
+                changed = await save_responses(rows)
+                break
+            except Exception as e:
+                logger.error("Ошибка записи %s откликов, повтор через %.1f с: %s", len(rows), delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        if not changed:
+            return
+        for incident_id in {row[0] for row in rows}:
+            stats_updater.mark_dirty(incident_id)
+
+    async def close(self):
+        # Дописываем все, что осталось в очереди
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+response_writer = ResponseWriter(RESPONSE_BATCH_SIZE, RESPONSE_FLUSH_INTERVAL, RESPONSE_QUEUE_SIZE)
+
+class CallbackGate:
+    """Отсекает повторные отклики и сглаживает частые до очереди записи.
+
+    Повтор — тот же статус, что уже принят от пользователя по этому инциденту. Чаще одной записи
+    за user_interval пользователь не пишет: смена статуса внутри интервала откладывается,
+    и по его истечении записывается последний статус.
+    """
+
+    def __init__(self, user_interval, maxsize, write):
+        self.user_interval = user_interval
+        self.maxsize = maxsize
+        self.write = write
+        self._last_status = OrderedDict()  # (user_id, incident_id): последний принятый статус
+        self._next_slot = {}  # user_id: monotonic-время, с которого можно писать снова
+        self._deferred = {}  # user_id: {incident_id: [статус, статус до откладывания]}
+        self._tasks = {}  # user_id: задача отложенной записи
+
+    def check(self, user_id, incident_id, status):
+        """'accepted' — отклик пишется сейчас, 'deferred' — после интервала, 'duplicate' — отбрасывается."""
+        key = (user_id, incident_id)
+        previous = self._last_status.get(key)
+        if previous == status:
+            return "duplicate"
+        self._last_status[key] = status
+        self._last_status.move_to_end(key)
+        if len(self._last_status) > self.maxsize:
+            self._last_status.popitem(last=False)
+
+        now = time.monotonic()
+        if len(self._next_slot) > self.maxsize:
+            self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+        slot = self._next_slot.get(user_id, 0.0)
+        if slot <= now and user_id not in self._deferred:
+            self._next_slot[user_id] = now + self.user_interval
+            return "accepted"
+        pending = self._deferred.setdefault(user_id, {})
+        if incident_id in pending:
+            CALLBACKS_DROPPED.inc(reason="coalesced")
+            pending[incident_id][0] = status
+        else:
+            pending[incident_id] = [status, previous]
+        if user_id not in self._tasks:
+            self._tasks[user_id] = asyncio.create_task(self._write_later(user_id, slot - now))
+        return "deferred"
+
+    async def _write_later(self, user_id, delay):
+        await asyncio.sleep(delay)
+        del self._tasks[user_id]
+        self._next_slot[user_id] = time.monotonic() + self.user_interval
+        await self._write_deferred(user_id)
+
+    async def _write_deferred(self, user_id):
+        for incident_id, (status, previous) in self._deferred.pop(user_id, {}).items():
+            # Пользователь вернулся к уже записанному статусу или инцидент закрыли, пока ждали
+            if status == previous or incident_id in closed_incidents:
+                CALLBACKS_DROPPED.inc(reason="coalesced")
+                continue
+            await self.write(incident_id, user_id, status)
+
+    async def close(self):
+        # Отложенные статусы записываются сразу, до остановки ResponseWriter
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        for user_id in list(self._deferred):
+            await self._write_deferred(user_id)
+
+callback_gate = CallbackGate(CALLBACK_USER_INTERVAL, CALLBACK_CACHE_SIZE, response_writer.put)
+
+# === ХРАНИЛИЩЕ СОСТОЯНИЙ (FSM) ===
+
+@db_task
+def load_fsm_states(conn, ttl, limit):
+    conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (int(time.time()) - ttl,))
+    conn.commit()
+    rows = conn.execute(
+        "SELECT key, state, data, updated_at FROM fsm_states ORDER BY updated_at DESC LIMIT ?", (limit,)
+    ).fetchall()
+    return rows[::-1]
+
+@db_task
+def get_fsm_state(conn, key, ttl):
+    return conn.execute(
+        "SELECT state, data, updated_at FROM fsm_states WHERE key=? AND updated_at >= ?", (key, int(time.time()) - ttl)
+    ).fetchone()
+
+@db_task
+def save_fsm_state(conn, key, state, data, updated_at, evicted):
+    if state is None and not data:
+        conn.execute("DELETE FROM fsm_states WHERE key=?", (key,))
+    else:
+        conn.execute(
+            """
+            INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+            """,
+            (key, state, json.dumps(data, ensure_ascii=False), updated_at)
+        )
+    conn.executemany("DELETE FROM fsm_states WHERE key=?", [(k,) for k in evicted])
+    conn.commit()
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище: таблица fsm_states и кэш в памяти (TTL и предел числа), запись насквозь.
+
+    При нескольких процессах следующий шаг мастера может прийти в другой процесс: промах кэша
+    читается из БД, а если БД менял кто-то еще (PRAGMA data_version), кэш сбрасывается.
+    """
+
+    def __init__(self, ttl, max_size, sync_interval, absent_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+        self.absent_size = absent_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._entries = OrderedDict()  # key: (state, data, updated_at), от давно измененных к свежим
+        # Ключи, которых нет в БД (большинство чатов мастер не открывали): промах без запроса к БД
+        self._absent = OrderedDict()
+        self._data_version = None
+        self._synced_at = 0.0
+
+    async def load(self):
+        self._data_version = await get_data_version()
+        self._synced_at = time.monotonic()
+        for key, state, data, updated_at in await load_fsm_states(self.ttl, self.max_size):
+            self._entries[key] = (state, json.loads(data), updated_at)
+        logger.info("Загружено %s незавершенных черновиков.", len(self._entries))
+
+    async def _sync(self):
+        # Шаги мастера — это сообщения человека, между ними заведомо больше sync_interval:
+        # изменение, сделанное другим процессом, будет замечено до следующего шага
+        if time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = time.monotonic()
+        data_version = await get_data_version()
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._entries.clear()
+            self._absent.clear()
+
+    async def _get(self, key):
+        key = self.key_builder.build(key)
+        await self._sync()
+        entry = self._entries.get(key)
+        if entry is None:
+            if key in self._absent:
+                return None
+            row = await get_fsm_state(key, self.ttl)
+            if row is None:
+                self._absent[key] = True
+                if len(self._absent) > self.absent_size:
+                    self._absent.popitem(last=False)
+                return None
+            state, data, updated_at = row
+            entry = self._entries[key] = (state, json.loads(data), updated_at)
+        if time.time() - entry[2] > self.ttl:
+            # Брошенный черновик: удаляем при первом обращении
+            await self._write(key, None, {})
+            return None
+        return entry
+
+    async def _write(self, key, state, data):
+        now = int(time.time())
+        self._absent.pop(key, None)
+        if state is None and not data:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = (state, data, now)
+            self._entries.move_to_end(key)
+        evicted = []
+        while self._entries:
+            oldest_key, (_, _, updated_at) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and now - updated_at <= self.ttl:
+                break
+            self._entries.popitem(last=False)
+            evicted.append(oldest_key)
+        await save_fsm_state(key, state, data, now, evicted)
+
+    async def set_state(self, key, state=None):
+        entry = await self._get(key)
+        state = state.state if isinstance(state, State) else state
+        await self._write(self.key_builder.build(key), state, entry[1] if entry else {})
+
+    async def get_state(self, key):
+        entry = await self._get(key)
+        return entry[0] if entry else None
+
+    async def set_data(self, key, data):
+        entry = await self._get(key)
+        await self._write(self.key_builder.build(key), entry[0] if entry else None, dict(data))
+
+    async def get_data(self, key):
+        entry = await self._get(key)
+        return dict(entry[1]) if entry else {}
+
+    async def close(self):
+        pass
+
+fsm_storage = SQLiteStorage(WIZARD_TTL, WIZARD_MAX_DRAFTS, FSM_SYNC_INTERVAL, USER_CACHE_SIZE)
+
 bot = Bot(
     token=API_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher()
+dp = Dispatcher(storage=fsm_storage)
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время обработки и число апдейтов в обработке, по типу апдейта; медленные хендлеры — в лог."""
+
+    def __init__(self, slow_threshold):
+        self.slow_threshold = slow_threshold
+
+    async def __call__(self, handler, event, data):
+        UPDATES_IN_FLIGHT.inc()
+        # Сюда HandlerNameMiddleware запишет имя хендлера, выбранного роутером
+        data["handler_info"] = handler_info = {}
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            UPDATES_IN_FLIGHT.dec()
+            UPDATE_SECONDS.observe(elapsed, type=event.event_type)
+            if elapsed >= self.slow_threshold:
+                log_event(
+                    "slow_handler", logging.WARNING, handler=handler_info.get("name", "unhandled"),
+                    update_type=event.event_type, elapsed_ms=round(elapsed * 1000, 1)
+                )
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренняя middleware: фильтры уже пройдены, data["handler"] — выбранный хендлер."""
+
+    async def __call__(self, handler, event, data):
+        handler_info = data.get("handler_info")
+        if handler_info is not None:
+            handler_info["name"] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+dp.update.outer_middleware(MetricsMiddleware(SLOW_HANDLER_THRESHOLD))
+for event_name, observer in dp.observers.items():
+    if event_name not in ("update", "error"):
+        observer.middleware(HandlerNameMiddleware())
+
+class Check(Filter):
+    """Magic-фильтр, проверяемый прямо в цикле событий.
+
+    Синхронные фильтры (lambda и голый F) aiogram вызывает через asyncio.to_thread — это переход
+    в пул потоков на каждую проверку каждого апдейта. Здесь тот же F вычисляется в async-фильтре.
+    """
+
+    def __init__(self, magic):
+        self.magic = magic
+
+    async def __call__(self, event):
+        return self.magic.resolve(event)
+
+# Роутеры: апдейт проверяет фильтры только тех хендлеров, чей роутер его пропустил
+commands_router = Router(name="commands")  # команды в любом чате, права и тип чата проверяются внутри
+commands_router.message.filter(Check(F.text.startswith("/")))
+private_router = Router(name="private")
+private_router.message.filter(Check(F.chat.type == "private"))
+private_router.edited_message.filter(Check(F.chat.type == "private"))
+callbacks_router = Router(name="callbacks")
+group_router = Router(name="group")  # из сообщений группы нужны только вход и выход участников
+group_router.message.filter(Check(F.chat.type.in_({"group", "supergroup"})))
+
+# Точный текст кнопки -> обработчик: один поиск в dict вместо цепочки фильтров
+BUTTON_HANDLERS = {}
+
+def button(text):
+    def register(handler):
+        BUTTON_HANDLERS[text] = handler
+        return handler
+    return register
 
 def incident_keyboard():
     kb = ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="Создать инцидент")],
+            [KeyboardButton(text="Поделиться геолокацией", request_location=True)],
             [KeyboardButton(text="Отписаться от рассылки")]
         ],
         resize_keyboard=True,
@@ -358,29 +2460,51 @@ def skip_or_cancel_keyboard():
         one_time_keyboard=True
     )
 
-incident_creation_state = {}  # user_id: {'step': ..., 'data': {...}}
+# Кнопка выбора: область рассылки инцидента с геолокацией
+DISPATCH_SCOPES = {
+    "Оповестить всех": "all",
+    "Сначала ближайших": "nearby_first",
+    "Только ближайших": "nearby_only",
+}
+
+def dispatch_scope_keyboard():
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text)] for text in DISPATCH_SCOPES] + [
+            [KeyboardButton(text="Отменить создание инцидента")]
+        ],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+class IncidentWizard(StatesGroup):
+    """Шаги создания инцидента; данные черновика — в FSMContext (description, place, lat, lon, photo, scope)."""
+    description = State()
+    place = State()
+    photo = State()
+    scope = State()
 
 # === КНОПКА ОТМЕНЫ НА ЛЮБОМ ШАГЕ СОЗДАНИЯ ИНЦИДЕНТА ===
 
-@dp.message(lambda m: m.chat.type == "private" and m.text == "Отменить создание инцидента")
-async def cancel_incident_creation(message: types.Message):
-    if incident_creation_state.pop(message.from_user.id, None) is not None:
+@button("Отменить создание инцидента")
+async def cancel_incident_creation(message: types.Message, state: FSMContext):
+    if await state.get_state() is not None:
+        await state.clear()
         await message.answer(
             "Создание инцидента отменено.",
             reply_markup=incident_keyboard()
         )
-        logger.info(f"user_id={message.from_user.id} отменил процесс создания инцидента.")
+        logger.info("user_id=%s отменил процесс создания инцидента.", message.from_user.id)
     else:
         await message.answer(
             "Нет активного процесса создания инцидента.",
             reply_markup=incident_keyboard()
         )
 
-@dp.message(Command("init_admins"))
+@commands_router.message(Command("init_admins"))
 async def cmd_init_admins(message: types.Message):
     logger.info(
-        f"/init_admins вызвана в чате {message.chat.id} тип={message.chat.type} "
-        f"(GROUP_CHAT_ID={GROUP_CHAT_ID}) message_thread_id={getattr(message, 'message_thread_id', None)}"
+        "/init_admins вызвана в чате %s тип=%s (GROUP_CHAT_ID=%s) message_thread_id=%s",
+        message.chat.id, message.chat.type, GROUP_CHAT_ID, getattr(message, 'message_thread_id', None)
     )
     if message.chat.type not in ("group", "supergroup"):
         await message.answer("Эту команду можно выполнять только в группе.")
@@ -388,9 +2512,9 @@ async def cmd_init_admins(message: types.Message):
         return
     try:
         admins = await bot.get_chat_administrators(message.chat.id)
-        logger.info(f"get_chat_administrators вернул {len(admins)} объектов")
+        logger.info("get_chat_administrators вернул %s объектов", len(admins))
     except Exception as e:
-        logger.error(f"Ошибка получения админов: {e}")
+        logger.error("Ошибка получения админов: %s", e)
         await message.answer(f"Ошибка получения админов: {str(e)}")
         return
     count = 0
@@ -398,25 +2522,24 @@ async def cmd_init_admins(message: types.Message):
     for admin in admins:
         u = admin.user
         logger.info(
-            f"Обработка admin: user_id={u.id}, username={u.username}, status={admin.status}, "
-            f"is_bot={u.is_bot}, from_chat_id={message.chat.id}, "
-            f"message_thread_id={getattr(message, 'message_thread_id', None)}"
+            "Обработка admin: user_id=%s, username=%s, status=%s, is_bot=%s, from_chat_id=%s, message_thread_id=%s",
+            u.id, u.username, admin.status, u.is_bot, message.chat.id, getattr(message, 'message_thread_id', None)
         )
         if admin.status in ("administrator", "creator") and not u.is_bot:
-            save_admin(u.id)
+            await save_admin(u.id)
             count += 1
             added_ids.append(f"{u.full_name or ''} (@{u.username})" if u.username else str(u.id))
     if count:
         admins_list = "\n".join(added_ids)
         await message.answer(f"Добавлено {count} администраторов (включая владельца группы):\n{admins_list}")
-        logger.info(f"Добавлено {count} админов: {admins_list}")
+        logger.info("Добавлено %s админов: %s", count, admins_list)
     else:
         await message.answer("Не найдено администраторов или владельца для добавления.")
         logger.info("Не найдено администраторов для добавления.")
 
 # === НОВЫЕ КОМАНДЫ ДЛЯ УПРАВЛЕНИЯ АДМИНАМИ ===
 
-@dp.message(Command("add_admin"))
+@commands_router.message(Command("add_admin"))
 async def cmd_add_admin(message: types.Message, command: CommandObject):
     # Только в личке и только админ может добавить другого админа
     if message.chat.type != "private":
@@ -424,7 +2547,7 @@ async def cmd_add_admin(message: types.Message, command: CommandObject):
         return
     if not is_admin(message.from_user.id):
         await message.answer("Только администратор может добавлять новых администраторов.")
-        logger.warning(f"user_id={message.from_user.id} попытался добавить админа без прав")
+        logger.warning("user_id=%s попытался добавить админа без прав", message.from_user.id)
         return
     if not command.args:
         await message.answer("Использование: /add_admin <user_id или @username>")
@@ -437,14 +2560,8 @@ async def cmd_add_admin(message: types.Message, command: CommandObject):
     if arg.startswith("@"):
         username = arg[1:]
         # Поиск по username в таблице users
-        conn = db_connect()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE username=?", (username,))
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            user_id = row[0]
-        else:
+        user_id = await get_user_id_by_username(username)
+        if user_id is None:
             await message.answer(f"Пользователь с username @{username} не найден в базе. Сначала он должен написать боту.")
             return
     else:
@@ -454,9 +2571,9 @@ async def cmd_add_admin(message: types.Message, command: CommandObject):
             await message.answer("Некорректный user_id. Используйте /add_admin <user_id или @username>")
             return
 
-    save_admin(user_id)
+    await save_admin(user_id)
     await message.answer(f"Пользователь с user_id={user_id} теперь администратор.")
-    logger.info(f"user_id={message.from_user.id} добавил админа user_id={user_id}")
+    logger.info("user_id=%s добавил админа user_id=%s", message.from_user.id, user_id)
 
     # Уведомление новому админу
     try:
@@ -465,11 +2582,11 @@ async def cmd_add_admin(message: types.Message, command: CommandObject):
             "Вам выданы права администратора в системе экстренных уведомлений. "
             "Теперь вы можете создавать инциденты и управлять другими администраторами через команды в личке с этим ботом."
         )
-        logger.info(f"Новому админу user_id={user_id} отправлено уведомление в личку.")
+        logger.info("Новому админу user_id=%s отправлено уведомление в личку.", user_id)
     except Exception as e:
-        logger.warning(f"Не удалось отправить личное сообщение новому админу user_id={user_id}: {e}")
+        logger.warning("Не удалось отправить личное сообщение новому админу user_id=%s: %s", user_id, e)
 
-@dp.message(Command("remove_admin"))
+@commands_router.message(Command("remove_admin"))
 async def cmd_remove_admin(message: types.Message, command: CommandObject):
     # Только в личке и только админ может удалять админа
     if message.chat.type != "private":
@@ -477,7 +2594,7 @@ async def cmd_remove_admin(message: types.Message, command: CommandObject):
         return
     if not is_admin(message.from_user.id):
         await message.answer("Только администратор может удалять других администраторов.")
-        logger.warning(f"user_id={message.from_user.id} попытался удалить админа без прав")
+        logger.warning("user_id=%s попытался удалить админа без прав", message.from_user.id)
         return
     if not command.args:
         await message.answer("Использование: /remove_admin <user_id или @username>")
@@ -488,14 +2605,8 @@ async def cmd_remove_admin(message: types.Message, command: CommandObject):
 
     if arg.startswith("@"):
         username = arg[1:]
-        conn = db_connect()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE username=?", (username,))
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            user_id = row[0]
-        else:
+        user_id = await get_user_id_by_username(username)
+        if user_id is None:
             await message.answer(f"Пользователь с username @{username} не найден в базе.")
             return
     else:
@@ -513,42 +2624,80 @@ async def cmd_remove_admin(message: types.Message, command: CommandObject):
         await message.answer(f"Пользователь с user_id={user_id} не является администратором.")
         return
 
-    delete_admin(user_id)
+    await delete_admin(user_id)
     await message.answer(f"Пользователь с user_id={user_id} больше не администратор.")
-    logger.info(f"user_id={message.from_user.id} удалил админа user_id={user_id}")
+    logger.info("user_id=%s удалил админа user_id=%s", message.from_user.id, user_id)
 
-@dp.message(Command("list_admins"))
+@commands_router.message(Command("list_admins"))
 async def cmd_list_admins(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("Только администратор может просматривать список администраторов.")
         return
-    admins = get_admins()
+    admins = await user_directory.get_many(sorted(admin_registry.ids))
     if not admins:
         await message.answer("Список администраторов пуст.")
         return
     text = "<b>Список администраторов:</b>\n"
-    conn = db_connect()
-    cur = conn.cursor()
-    for uid in admins:
-        cur.execute("SELECT first_name, username FROM users WHERE user_id=?", (uid,))
-        row = cur.fetchone()
+    for uid, (fname, username, _) in admins.items():
         user_desc = f"{uid}"
-        if row:
-            fname, username = row
-            if fname:
-                user_desc = fname
-            if username:
-                user_desc += f" (@{username})"
+        if fname:
+            user_desc = fname
+        if username:
+            user_desc += f" (@{username})"
         text += f"- {user_desc}\n"
-    conn.close()
     await message.answer(text)
 
+# === ПРОФИЛИРОВАНИЕ ===
+# cProfile видит только поток event loop; время в потоке БД смотрите в метрике sosbot_db_call_seconds.
+
+profile_lock = asyncio.Lock()
+
+def render_profile(profiler, limit=40):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs()
+    for sort_key in ("cumulative", "tottime"):
+        out.write(f"=== Сортировка по {sort_key} ===\n")
+        stats.sort_stats(sort_key).print_stats(limit)
+    return out.getvalue()
+
+@commands_router.message(Command("profile"))
+async def cmd_profile(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("Только администратор может запускать профилирование.")
+        logger.warning("user_id=%s попытался вызвать /profile без прав", message.from_user.id)
+        return
+    try:
+        seconds = int(command.args) if command.args else 30
+    except ValueError:
+        await message.answer("Использование: /profile <секунд>")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if profile_lock.locked():
+        await message.answer("Профилирование уже запущено, дождитесь результата.")
+        return
+    async with profile_lock:
+        logger.info("user_id=%s запустил профилирование на %s с", message.from_user.id, seconds)
+        await message.answer(f"Профилирую {seconds} с...")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        # Сортировка и форматирование статистики — не в event loop
+        report = await asyncio.get_running_loop().run_in_executor(None, render_profile, profiler)
+    await message.answer_document(
+        BufferedInputFile(report.encode("utf-8"), filename=f"profile_{int(time.time())}.txt"),
+        caption=f"Самые затратные функции за {seconds} с."
+    )
+
 # === ОСНОВНОЙ ФУНКЦИОНАЛ (оставлен без изменений, кроме help) ===
 
-@dp.message(Command("start"))
+@commands_router.message(Command("start"))
 async def cmd_start(message: types.Message):
-    logger.info(f"/start от user_id={message.from_user.id} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-    save_user(message.from_user)
+    logger.info("/start от user_id=%s (GROUP_CHAT_ID=%s)", message.from_user.id, GROUP_CHAT_ID)
+    await save_user(message.from_user)
     await message.answer(
         "Вы подписаны на экстренные уведомления группы безопасности. "
         "Чтобы создать инцидент, нажмите кнопку ниже.\n"
@@ -556,142 +2705,165 @@ async def cmd_start(message: types.Message):
         reply_markup=incident_keyboard()
     )
 
-@dp.message(Command("help"))
+@commands_router.message(Command("help"))
 async def cmd_help(message: types.Message):
-    logger.info(f"/help от user_id={message.from_user.id} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
+    logger.info("/help от user_id=%s (GROUP_CHAT_ID=%s)", message.from_user.id, GROUP_CHAT_ID)
     await message.answer(
         "/notify &lt;текст&gt; — отправить экстренное уведомление (только для администратора)\n"
         "/report — получить отчет по происшествиям (только для администратора)\n"
+        "/close &lt;id&gt; [delete] — закрыть инцидент и убрать кнопки у получателей (только для администратора)\n"
+        "/stats [user_id или @username] — надежность откликов по всем инцидентам (только для администратора)\n"
         "/init_admins — инициализировать список админов из админов группы (выполнять только в группе)\n"
         "/add_admin &lt;user_id или @username&gt; — добавить администратора (только для администратора, в личке)\n"
         "/remove_admin &lt;user_id или @username&gt; — удалить администратора (только для администратора, в личке)\n"
         "/list_admins — показать список админов (только для администратора)\n"
+        "/sync_members — сверить список участников с группой (только для администратора)\n"
+        "/profile &lt;секунд&gt; — профилировать бота и прислать отчет (только для администратора)\n"
         "/stop — отписаться от экстренной рассылки\n"
-        "В личке используйте кнопку 'Создать инцидент'.",
+        "В личке используйте кнопку 'Создать инцидент'.\n"
+        "Кнопка 'Поделиться геолокацией' (или трансляция геопозиции) — чтобы получать уведомления о происшествиях рядом в числе первых.",
         reply_markup=incident_keyboard()
     )
 
-@dp.message(Command("stop"))
+@commands_router.message(Command("stop"))
 async def cmd_stop(message: types.Message):
-    unsubscribe_user(message.from_user.id)
-    logger.info(f"user_id={message.from_user.id} отписался от рассылки (GROUP_CHAT_ID={GROUP_CHAT_ID})")
+    await unsubscribe_user(message.from_user.id)
+    logger.info("user_id=%s отписался от рассылки (GROUP_CHAT_ID=%s)", message.from_user.id, GROUP_CHAT_ID)
     await message.answer(
         "Вы отписались от экстренных уведомлений. Если захотите снова получать рассылку, нажмите кнопку ниже.",
         reply_markup=subscribe_keyboard()
     )
 
-@dp.message(lambda m: m.chat.type == "private" and m.text == "Отписаться от рассылки")
-async def handle_unsubscribe(message: types.Message):
-    unsubscribe_user(message.from_user.id)
-    logger.info(f"user_id={message.from_user.id} отписался от рассылки через кнопку (GROUP_CHAT_ID={GROUP_CHAT_ID})")
+@button("Отписаться от рассылки")
+async def handle_unsubscribe(message: types.Message, state: FSMContext):
+    await unsubscribe_user(message.from_user.id)
+    logger.info("user_id=%s отписался от рассылки через кнопку (GROUP_CHAT_ID=%s)", message.from_user.id, GROUP_CHAT_ID)
     await message.answer(
         "Вы отписались от экстренных уведомлений. Если захотите снова получать рассылку, нажмите кнопку ниже.",
         reply_markup=subscribe_keyboard()
     )
 
-@dp.message(lambda m: m.chat.type == "private" and m.text == "Подписаться на рассылку")
-async def handle_subscribe(message: types.Message):
-    subscribe_user(message.from_user)
-    logger.info(f"user_id={message.from_user.id} подписался на рассылку через кнопку (GROUP_CHAT_ID={GROUP_CHAT_ID})")
+@button("Подписаться на рассылку")
+async def handle_subscribe(message: types.Message, state: FSMContext):
+    await subscribe_user(message.from_user)
+    logger.info("user_id=%s подписался на рассылку через кнопку (GROUP_CHAT_ID=%s)", message.from_user.id, GROUP_CHAT_ID)
     await message.answer(
         "Вы снова подписаны на экстренные уведомления.",
         reply_markup=incident_keyboard()
     )
 
-@dp.message(lambda m: m.chat.type == "private" and m.text == "Создать инцидент")
-async def start_incident_creation(message: types.Message):
+@button("Создать инцидент")
+async def start_incident_creation(message: types.Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         await message.answer("Только администратор может создавать инциденты.")
-        logger.warning(f"user_id={message.from_user.id} попытался создать инцидент без прав")
+        logger.warning("user_id=%s попытался создать инцидент без прав", message.from_user.id)
         return
-    incident_creation_state[message.from_user.id] = {'step': 'description', 'data': {}}
-    logger.info(f"user_id={message.from_user.id} начал создание инцидента (GROUP_CHAT_ID={GROUP_CHAT_ID})")
+    await state.set_data({})
+    await state.set_state(IncidentWizard.description)
+    logger.info("user_id=%s начал создание инцидента (GROUP_CHAT_ID=%s)", message.from_user.id, GROUP_CHAT_ID)
     await message.answer(
         "Пожалуйста, опишите ситуацию (текст инцидента):",
         reply_markup=cancel_creation_keyboard()
     )
 
-@dp.message(lambda m: m.chat.type == "private" and incident_creation_state.get(m.from_user.id, {}).get('step') == 'description')
-async def incident_description(message: types.Message):
-    if message.text == "Отменить создание инцидента":
-        await cancel_incident_creation(message)
-        return
-    incident_creation_state[message.from_user.id]['data']['description'] = message.text.strip()
-    incident_creation_state[message.from_user.id]['step'] = 'place'
+# Кнопки проверяются раньше шагов мастера: "Отменить создание инцидента" работает на любом шаге
+@private_router.message(Check(F.text.in_(BUTTON_HANDLERS)))
+async def handle_button(message: types.Message, state: FSMContext, handler_info: dict = None):
+    handler = BUTTON_HANDLERS[message.text]
+    if handler_info is not None:
+        handler_info["name"] = handler.__name__
+    await handler(message, state)
+
+# Шаги мастера выбираются по сохраненному состоянию
+
+@private_router.message(StateFilter(IncidentWizard.description), Check(F.text))
+async def incident_description(message: types.Message, state: FSMContext):
+    await state.update_data(description=message.text.strip())
+    await state.set_state(IncidentWizard.place)
     await message.answer("Укажите место сбора (можно текстом или геолокацией):", reply_markup=cancel_creation_keyboard())
 
-@dp.message(lambda m: m.chat.type == "private" and incident_creation_state.get(m.from_user.id, {}).get('step') == 'place' and m.location is not None)
-async def incident_place_location(message: types.Message):
-    data = incident_creation_state[message.from_user.id]['data']
-    data['place'] = f"Геолокация: {message.location.latitude}, {message.location.longitude}"
-    incident_creation_state[message.from_user.id]['step'] = 'photo'
+@private_router.message(StateFilter(IncidentWizard.place), Check(F.location))
+async def incident_place_location(message: types.Message, state: FSMContext):
+    await state.update_data(
+        place=f"Геолокация: {message.location.latitude}, {message.location.longitude}",
+        lat=message.location.latitude,
+        lon=message.location.longitude
+    )
+    await state.set_state(IncidentWizard.photo)
     await message.answer("Прикрепите фото (опционально) или нажмите 'Пропустить':", reply_markup=skip_or_cancel_keyboard())
 
-@dp.message(lambda m: m.chat.type == "private" and incident_creation_state.get(m.from_user.id, {}).get('step') == 'place' and m.text != "Отменить создание инцидента")
-async def incident_place_text(message: types.Message):
-    if message.text == "Отменить создание инцидента":
-        await cancel_incident_creation(message)
-        return
-    data = incident_creation_state[message.from_user.id]['data']
-    data['place'] = message.text.strip()
-    incident_creation_state[message.from_user.id]['step'] = 'photo'
+@private_router.message(StateFilter(IncidentWizard.place), Check(F.text))
+async def incident_place_text(message: types.Message, state: FSMContext):
+    await state.update_data(place=message.text.strip())
+    await state.set_state(IncidentWizard.photo)
     await message.answer("Прикрепите фото (опционально) или нажмите 'Пропустить':", reply_markup=skip_or_cancel_keyboard())
 
-@dp.message(lambda m: m.chat.type == "private" and incident_creation_state.get(m.from_user.id, {}).get('step') == 'photo' and m.photo is not None)
-async def incident_photo(message: types.Message):
-    photo = message.photo[-1].file_id
-    incident_creation_state[message.from_user.id]['data']['photo'] = photo
-    await finish_incident_creation(message)
+@private_router.message(StateFilter(IncidentWizard.photo), Check(F.photo))
+async def incident_photo(message: types.Message, state: FSMContext):
+    await state.update_data(photo=message.photo[-1].file_id)
+    await ask_scope_or_finish(message, state)
+
+@private_router.message(StateFilter(IncidentWizard.photo), Check(F.text == "Пропустить"))
+async def skip_photo(message: types.Message, state: FSMContext):
+    await ask_scope_or_finish(message, state)
+
+async def ask_scope_or_finish(message: types.Message, state: FSMContext):
+    # Выбор области рассылки имеет смысл, только если место сбора задано геолокацией
+    if 'lat' not in await state.get_data():
+        await finish_incident_creation(message, state)
+        return
+    await state.set_state(IncidentWizard.scope)
+    await message.answer(
+        f"Кого оповестить? Ближайшие — подписчики в радиусе {GEO_RADIUS_KM:g} км от места сбора.",
+        reply_markup=dispatch_scope_keyboard()
+    )
+
+@private_router.message(StateFilter(IncidentWizard.scope), Check(F.text.in_(DISPATCH_SCOPES)))
+async def incident_scope(message: types.Message, state: FSMContext):
+    await state.update_data(scope=DISPATCH_SCOPES[message.text])
+    await finish_incident_creation(message, state)
 
-@dp.message(lambda m: m.chat.type == "private" and incident_creation_state.get(m.from_user.id, {}).get('step') == 'photo' and m.text == "Пропустить")
-async def skip_photo(message: types.Message):
-    await finish_incident_creation(message)
+@private_router.message(Check(F.location))
+async def handle_user_location(message: types.Message):
+    await save_user_location(message.from_user.id, message.location.latitude, message.location.longitude)
+    log_event("location_saved", user_id=message.from_user.id, live=bool(message.location.live_period))
+    await message.answer(
+        "Геолокация сохранена: при происшествиях рядом вы получите уведомление в числе первых. "
+        "Трансляция геопозиции будет обновлять ее автоматически.",
+        reply_markup=incident_keyboard()
+    )
 
-@dp.message(lambda m: m.chat.type == "private" and incident_creation_state.get(m.from_user.id, {}).get('step') == 'photo' and m.text == "Отменить создание инцидента")
-async def cancel_incident_creation_on_photo(message: types.Message):
-    await cancel_incident_creation(message)
+@private_router.edited_message(Check(F.location))
+async def handle_live_location(message: types.Message):
+    # Трансляция геопозиции приходит правками исходного сообщения
+    await save_user_location(message.from_user.id, message.location.latitude, message.location.longitude)
 
-async def finish_incident_creation(message: types.Message):
-    data = incident_creation_state.pop(message.from_user.id)['data']
+async def finish_incident_creation(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.clear()
     description = data.get('description', '')
     place = data.get('place', '')
     photo = data.get('photo', None)
+    lat, lon = data.get('lat'), data.get('lon')
+    scope = data.get('scope', 'all')
     creator_id = message.from_user.id
 
     # Сохраняем creator_id!
-    incident_id = save_incident(description, place, photo, None, creator_id)
-
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="Пойду", callback_data=f"go_{incident_id}"),
-        InlineKeyboardButton(text="Не могу", callback_data=f"no_{incident_id}")
-    )
-    notify_text = f"<b>Экстренное сообщение:</b>\n{description}\n\n<b>Место сбора:</b> {place}"
-    count = 0
-    for uid in get_group_members():
-        try:
-            if photo:
-                await bot.send_photo(
-                    uid,
-                    photo=photo,
-                    caption=notify_text,
-                    reply_markup=builder.as_markup()
-                )
-            else:
-                await bot.send_message(
-                    uid,
-                    notify_text,
-                    reply_markup=builder.as_markup()
-                )
-            logger.info(f"Уведомление отправлено user_id={uid} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-            count += 1
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления user_id={uid} (GROUP_CHAT_ID={GROUP_CHAT_ID}): {e}")
-
-    stats_text = get_incident_stats_text(incident_id)
+    incident_id = await save_incident(description, place, photo, None, creator_id, lat, lon)
+    nearby = None
+    if scope != 'all':
+        nearby = await get_nearby_users(lat, lon, GEO_RADIUS_KM, GEO_NEARBY_LIMIT)
+        logger.info("Инцидент %s: %s подписчиков в радиусе %s км, область рассылки %s", incident_id, len(nearby), GEO_RADIUS_KM, scope)
+    # Если рядом никого нет, "только ближайших" означало бы не оповестить никого
+    nearby_only = scope == 'nearby_only' and bool(nearby)
+    await outbox_enqueue(incident_id, nearby, nearby_only)
+    await followups.schedule(incident_id)
+    result = await outbox.drain(incident_id)
+
+    stats_text = render_stats_text(await get_incident_snapshot(incident_id))
     stats_msg_id = None
     try:
-        logger.info(f"Пробую отправить статистику в дефолтную тему group_id={GROUP_CHAT_ID}")
+        logger.info("Пробую отправить статистику в дефолтную тему group_id=%s", GROUP_CHAT_ID)
         if photo:
             stats_msg = await bot.send_photo(
                 chat_id=GROUP_CHAT_ID,
@@ -706,65 +2878,59 @@ async def finish_incident_creation(message: types.Message):
             )
             stats_msg_id = stats_msg.message_id
 
-        logger.info(f"Статистика по инциденту {incident_id} отправлена в дефолтную тему group_id={GROUP_CHAT_ID} (msg_id={stats_msg_id})")
-        set_incident_stats_msg(incident_id, stats_msg_id)
+        logger.info("Статистика по инциденту %s отправлена в дефолтную тему group_id=%s (msg_id=%s)", incident_id, GROUP_CHAT_ID, stats_msg_id)
+        await set_incident_stats_msg(incident_id, stats_msg_id)
+        stats_updater.remember(incident_id, stats_text)
 
         # --- Закрепляем сообщение с уведомлением всей группы! ---
         await bot.pin_chat_message(GROUP_CHAT_ID, stats_msg_id, disable_notification=False)
-        logger.info(f"Сообщение (msg_id={stats_msg_id}) закреплено в группе {GROUP_CHAT_ID}.")
+        logger.info("Сообщение (msg_id=%s) закреплено в группе %s.", stats_msg_id, GROUP_CHAT_ID)
 
     except Exception as e:
-        logger.error(f"Ошибка отправки статистики или закрепления в group_id={GROUP_CHAT_ID}: {e}")
-
-    await message.answer(f"Инцидент создан и уведомление отправлено {count} участникам.", reply_markup=incident_keyboard())
+        logger.error("Ошибка отправки статистики или закрепления в group_id=%s: %s", GROUP_CHAT_ID, e)
+
+    counts = await get_outbox_counts(incident_id)
+    scope_note = ""
+    if nearby is not None:
+        scope_note = f"\nРядом с местом сбора: {len(nearby)} подписчиков."
+        if scope == 'nearby_only' and not nearby_only:
+            scope_note += " Поблизости никого нет, поэтому оповещены все."
+    await message.answer(
+        f"Инцидент создан и уведомление отправлено {counts['sent']} участникам, "
+        f"не доставлено {counts['failed']} (последняя доставка через {result.elapsed:.1f} с).{scope_note}",
+        reply_markup=incident_keyboard()
+    )
 
-@dp.callback_query(lambda c: c.data and c.data.startswith(("go_", "no_")))
+@callbacks_router.callback_query(Check(F.data.startswith(("go_", "no_"))))
 async def inline_response(call: types.CallbackQuery):
     action, incident_id = call.data.split("_")
     incident_id = int(incident_id)
     user_id = call.from_user.id
-    logger.info(f"inline_response: action={action}, incident_id={incident_id}, user_id={user_id} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-
-    if action == "go":
-        save_response(incident_id, user_id, "Пойду")
+    if incident_id in closed_incidents:
+        log_event("callback", action=action, incident_id=incident_id, user_id=user_id, verdict="closed")
+        await call.answer("Инцидент закрыт, отклики больше не принимаются.")
         await call.message.edit_reply_markup(reply_markup=None)
-        await call.answer("Спасибо, ваш отклик зафиксирован!")
-    elif action == "no":
-        save_response(incident_id, user_id, "Не могу")
-        await call.message.edit_reply_markup(reply_markup=None)
-        await call.answer("Спасибо, ваш отклик зафиксирован.")
+        return
 
-    stats_msg_id = get_incident_stats_msg_id(incident_id)
-    if stats_msg_id:
-        stats_text = get_incident_stats_text(incident_id)
-        info = get_incident_info(incident_id)
-        photo_id = info[2] if info else None
-        try:
-            logger.info(f"Обновляю статистику по инциденту {incident_id} в group_id={GROUP_CHAT_ID}, msg_id={stats_msg_id}")
-            if photo_id:
-                await bot.edit_message_caption(
-                    chat_id=GROUP_CHAT_ID,
-                    message_id=stats_msg_id,
-                    caption=stats_text,
-                    parse_mode=ParseMode.HTML
-                )
-            else:
-                await bot.edit_message_text(
-                    chat_id=GROUP_CHAT_ID,
-                    message_id=stats_msg_id,
-                    text=stats_text,
-                    parse_mode=ParseMode.HTML
-                )
-            logger.info(f"Статистика инцидента {incident_id} обновлена в дефолтной теме group_id={GROUP_CHAT_ID}.")
-        except Exception as e:
-            logger.error(f"Ошибка обновления статистики по инциденту {incident_id} group_id={GROUP_CHAT_ID}: {e}")
+    status = "Пойду" if action == "go" else "Не могу"
+    verdict = callback_gate.check(user_id, incident_id, status)
+    log_event("callback", action=action, incident_id=incident_id, user_id=user_id, verdict=verdict)
+    # Подтверждение сразу, до очереди записи; повтор и отложенный отклик больше ничего не стоят
+    await call.answer("Спасибо, ваш отклик зафиксирован!" if action == "go" else "Спасибо, ваш отклик зафиксирован.")
+    if verdict == "duplicate":
+        CALLBACKS_DROPPED.inc(reason=verdict)
+    if verdict != "accepted":
+        return
+    # Отклик пишется в БД фоном, статистику обновит ResponseWriter после записи
+    await response_writer.put(incident_id, user_id, status)
+    await call.message.edit_reply_markup(reply_markup=None)
 
-@dp.message(Command("notify"))
+@commands_router.message(Command("notify"))
 async def cmd_notify(message: types.Message, command: CommandObject):
-    logger.info(f"/notify от user_id={message.from_user.id} (GROUP_CHAT_ID={GROUP_CHAT_ID}) args={command.args}")
+    logger.info("/notify от user_id=%s (GROUP_CHAT_ID=%s) args=%s", message.from_user.id, GROUP_CHAT_ID, command.args)
     if not is_admin(message.from_user.id):
         await message.answer("Только администратор может отправлять уведомления.")
-        logger.warning(f"user_id={message.from_user.id} попытался вызвать /notify без прав")
+        logger.warning("user_id=%s попытался вызвать /notify без прав", message.from_user.id)
         return
 
     if not command.args:
@@ -772,53 +2938,44 @@ async def cmd_notify(message: types.Message, command: CommandObject):
         return
 
     # creator_id — это message.from_user.id
-    incident_id = save_incident(command.args, None, None, None, message.from_user.id)
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="Пойду", callback_data=f"go_{incident_id}"),
-        InlineKeyboardButton(text="Не могу", callback_data=f"no_{incident_id}")
-    )
-    count = 0
-    for user_id in get_group_members():
-        try:
-            await bot.send_message(
-                user_id,
-                f"<b>Экстренное сообщение:</b>\n{command.args}",
-                reply_markup=builder.as_markup()
-            )
-            logger.info(f"Уведомление отправлено user_id={user_id} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-            count += 1
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления user_id={user_id} (GROUP_CHAT_ID={GROUP_CHAT_ID}): {e}")
+    incident_id = await save_incident(command.args, None, None, None, message.from_user.id)
+    await outbox_enqueue(incident_id)
+    await followups.schedule(incident_id)
+    result = await outbox.drain(incident_id)
 
-    stats_text = get_incident_stats_text(incident_id)
+    stats_text = render_stats_text(await get_incident_snapshot(incident_id))
     stats_msg_id = None
     try:
-        logger.info(f"Пробую отправить статистику в дефолтную тему group_id={GROUP_CHAT_ID}")
+        logger.info("Пробую отправить статистику в дефолтную тему group_id=%s", GROUP_CHAT_ID)
         stats_msg = await bot.send_message(
             chat_id=GROUP_CHAT_ID,
             text=stats_text
         )
         stats_msg_id = stats_msg.message_id
-        set_incident_stats_msg(incident_id, stats_msg_id)
-        logger.info(f"Статистика по инциденту {incident_id} отправлена в дефолтную тему group_id={GROUP_CHAT_ID} (msg_id={stats_msg_id})")
+        await set_incident_stats_msg(incident_id, stats_msg_id)
+        stats_updater.remember(incident_id, stats_text)
+        logger.info("Статистика по инциденту %s отправлена в дефолтную тему group_id=%s (msg_id=%s)", incident_id, GROUP_CHAT_ID, stats_msg_id)
         # --- Закрепляем сообщение с уведомлением всей группы! ---
         await bot.pin_chat_message(GROUP_CHAT_ID, stats_msg_id, disable_notification=False)
-        logger.info(f"Сообщение (msg_id={stats_msg_id}) закреплено в группе {GROUP_CHAT_ID}.")
+        logger.info("Сообщение (msg_id=%s) закреплено в группе %s.", stats_msg_id, GROUP_CHAT_ID)
     except Exception as e:
-        logger.error(f"Ошибка отправки статистики или закрепления в group_id={GROUP_CHAT_ID}: {e}")
+        logger.error("Ошибка отправки статистики или закрепления в group_id=%s: %s", GROUP_CHAT_ID, e)
 
-    await message.answer(f"Уведомление отправлено {count} участникам.")
+    counts = await get_outbox_counts(incident_id)
+    await message.answer(
+        f"Уведомление отправлено {counts['sent']} участникам, не доставлено {counts['failed']} "
+        f"(последняя доставка через {result.elapsed:.1f} с)."
+    )
 
-@dp.message(Command("report"))
+@commands_router.message(Command("report"))
 async def cmd_report(message: types.Message):
-    logger.info(f"/report от user_id={message.from_user.id} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
+    logger.info("/report от user_id=%s (GROUP_CHAT_ID=%s)", message.from_user.id, GROUP_CHAT_ID)
     if not is_admin(message.from_user.id):
         await message.answer("Только администратор может получать отчет.")
-        logger.warning(f"user_id={message.from_user.id} попытался вызвать /report без прав")
+        logger.warning("user_id=%s попытался вызвать /report без прав", message.from_user.id)
         return
 
-    incidents = get_recent_incidents(limit=5)
+    incidents = await get_recent_incidents(limit=5)
     if not incidents:
         await message.answer("Нет происшествий.")
         return
@@ -836,57 +2993,284 @@ async def cmd_report(message: types.Message):
         reply_markup=builder.as_markup()
     )
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("report_"))
+@callbacks_router.callback_query(Check(F.data.startswith("report_")))
 async def report_incident_callback(call: types.CallbackQuery):
     incident_id = int(call.data.split("_")[1])
-    logger.info(f"Отправка отчета по инциденту {incident_id} по callback (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-    info = get_incident_info(incident_id)
-    if not info:
+    logger.info("Отправка отчета по инциденту %s по callback (GROUP_CHAT_ID=%s)", incident_id, GROUP_CHAT_ID)
+    snap = await get_incident_snapshot(incident_id, with_lists=False)
+    if not snap:
         await call.answer("Инцидент не найден.", show_alert=True)
         return
-    description, place, photo_id, dt, creator_id = info
-    dt_str = utc_to_msk(dt)
-    responses, missed = get_report(incident_id)
-    creator_tag = get_user_tag(creator_id) if creator_id else "Неизвестен"
-    text = f"<b>Отчет по происшествию:</b>\n{description}\n<b>Создатель:</b> {creator_tag}"
-    if place:
-        text += f"\n<b>Место сбора:</b> {place}"
-    text += f"\n<b>Время:</b> {dt_str}\n\n"
-    if responses:
-        text += "<b>Откликнулись:</b>\n"
-        for fname, username, status, lat, lon, user_id in responses:
-            tag = f"@{username}" if username else f"id:{user_id}"
-            text += f" - {tag}: {status}\n"
-    if missed:
-        text += "\n<b>Не ответили:</b>\n"
-        for uid, fname, username in missed:
-            tag = f"@{username}" if username else f"id:{uid}"
-            text += f" - {tag}\n"
-    if photo_id:
-        await call.message.answer_photo(photo=photo_id, caption=text)
+    missed_count = snap.missed_count if snap.notified else await count_missed(incident_id)
+    logger.info("Формируется отчет: %s ответивших, %s не ответивших.", snap.go_count + snap.no_count, missed_count)
+    text = f"<b>Отчет по происшествию:</b>\n{snap.text}\n<b>Создатель:</b> {snap.creator_tag}"
+    if snap.place:
+        text += f"\n<b>Место сбора:</b> {snap.place}"
+    text += f"\n<b>Время:</b> {utc_to_msk(snap.dt)}\n\n"
+    text += f"<b>Пойдут:</b> {snap.go_count}\n<b>Не могут:</b> {snap.no_count}\n<b>Не ответили:</b> {missed_count}"
+    if snap.photo_id and len(text) <= CAPTION_LIMIT:
+        await call.message.answer_photo(photo=snap.photo_id, caption=text)
     else:
-        await call.message.answer(text)
+        if snap.photo_id:
+            await call.message.answer_photo(photo=snap.photo_id)
+        await call.message.answer(text[:TEXT_LIMIT])
+    # Списки идут отдельными страницами с кнопкой "Далее"
+    for section in REPORT_SECTIONS:
+        page_text, markup, has_rows = await build_report_page(section, incident_id, 0)
+        if has_rows:
+            await call.message.answer(page_text, reply_markup=markup)
     await call.answer()
 
-@dp.message(lambda m: m.chat.type in ("group", "supergroup"))
+# section: (заголовок, выборка страницы)
+REPORT_SECTIONS = {
+    "r": ("Откликнулись", get_responders_page),
+    "m": ("Не ответили", get_report),
+}
+
+async def build_report_page(section, incident_id, after_user_id):
+    title, fetch_page = REPORT_SECTIONS[section]
+    rows = await fetch_page(incident_id, after_user_id, REPORT_PAGE_SIZE + 1)
+    text = f"<b>{title}:</b>\n" if not after_user_id else f"<b>{title} (продолжение):</b>\n"
+    next_after = None
+    for i, row in enumerate(rows):
+        user_id, username, first_name = row[:3]
+        user_directory.prime(user_id, username, first_name)
+        line = f" - {format_user_tag(user_id, username, first_name)}"
+        if section == "r":
+            line += f": {row[3]}"
+        line += "\n"
+        if i == REPORT_PAGE_SIZE or len(text) + len(line) > TEXT_LIMIT - 100:
+            next_after = rows[i - 1][0]
+            break
+        text += line
+    builder = InlineKeyboardBuilder()
+    nav = []
+    if after_user_id:
+        nav.append(InlineKeyboardButton(text="« В начало", callback_data=f"rp_{section}_{incident_id}_0"))
+    if next_after:
+        nav.append(InlineKeyboardButton(text="Далее »", callback_data=f"rp_{section}_{incident_id}_{next_after}"))
+    if nav:
+        builder.row(*nav)
+    return text, builder.as_markup() if nav else None, bool(rows)
+
+@callbacks_router.callback_query(Check(F.data.startswith("rp_")))
+async def report_page_callback(call: types.CallbackQuery):
+    if not is_admin(call.from_user.id):
+        await call.answer("Только администратор может получать отчет.", show_alert=True)
+        return
+    _, section, incident_id, after_user_id = call.data.split("_")
+    if section not in REPORT_SECTIONS:
+        await call.answer()
+        return
+    text, markup, _ = await build_report_page(section, int(incident_id), int(after_user_id))
+    try:
+        await call.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    await call.answer()
+
+@commands_router.message(Command("close"))
+async def cmd_close(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("Только администратор может закрывать инциденты.")
+        logger.warning("user_id=%s попытался вызвать /close без прав", message.from_user.id)
+        return
+    args = (command.args or "").split()
+    if not args or not args[0].isdigit() or args[1:] not in ([], ["delete"]):
+        await message.answer("Использование: /close &lt;id инцидента&gt; [delete]")
+        return
+    incident_id = int(args[0])
+    delete = args[1:] == ["delete"]
+    snap = await get_incident_snapshot(incident_id, with_lists=False)
+    if not snap:
+        await message.answer(f"Инцидент {incident_id} не найден.")
+        return
+    if incident_id in closed_incidents or not await close_incident(incident_id, delete):
+        closed_incidents.add(incident_id)
+        await message.answer(f"Инцидент {incident_id} уже закрыт.")
+        return
+    closed_incidents.add(incident_id)
+    logger.info("user_id=%s закрыл инцидент %s (delete=%s)", message.from_user.id, incident_id, delete)
+
+    if snap.stats_msg_id:
+        try:
+            await bot.unpin_chat_message(GROUP_CHAT_ID, message_id=snap.stats_msg_id)
+        except Exception as e:
+            logger.error("Не удалось открепить статистику инцидента %s в group_id=%s: %s", incident_id, GROUP_CHAT_ID, e)
+    await message.answer(f"Инцидент {incident_id} закрыт, {'удаляю' if delete else 'обновляю'} оповещения у получателей...")
+    result = await recall_alerts(incident_id)
+    await message.answer(
+        f"Оповещения и напоминания по инциденту {incident_id} {'удалены' if delete else 'обновлены'}: "
+        f"{result.sent} сообщений, не удалось — {result.failed}."
+    )
+
+@commands_router.message(Command("sync_members"))
+async def cmd_sync_members(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("Только администратор может запускать сверку участников.")
+        logger.warning("user_id=%s попытался вызвать /sync_members без прав", message.from_user.id)
+        return
+    if member_sync.running:
+        await message.answer("Сверка участников уже идет.")
+        return
+    logger.info("user_id=%s запустил сверку участников группы %s", message.from_user.id, GROUP_CHAT_ID)
+    # Сверка идет фоном, прогресс — правками этого сообщения
+    progress_message = await message.answer("Сверка участников запущена...")
+    member_sync.start(progress_message)
+
+@commands_router.message(Command("stats"))
+async def cmd_stats(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("Только администратор может просматривать статистику.")
+        logger.warning("user_id=%s попытался вызвать /stats без прав", message.from_user.id)
+        return
+    if command.args:
+        arg = command.args.strip()
+        if arg.startswith("@"):
+            user_id = await get_user_id_by_username(arg[1:])
+        else:
+            try:
+                user_id = int(arg)
+            except ValueError:
+                await message.answer("Использование: /stats [user_id или @username]")
+                return
+        row = await get_user_stats(user_id) if user_id is not None else None
+        if not row:
+            await message.answer(f"Нет статистики откликов для {arg}.")
+            return
+        await message.answer(format_user_stats(row))
+        return
+    incidents, notified, go_count, no_count = await get_stats_totals()
+    text = (
+        f"<b>Статистика откликов</b>\nИнцидентов: {incidents}\nДоставлено уведомлений: {notified}\n"
+        f"Пойду: {go_count}\nНе могу: {no_count}\n\n<b>Самые надежные:</b>\n"
+    )
+    rows = await get_top_user_stats(10)
+    text += "\n".join(f"{i}. {format_user_stats(row)}" for i, row in enumerate(rows, start=1)) or "пока нет данных"
+    await message.answer(text[:TEXT_LIMIT])
+
+@group_router.message(Check(F.content_type.in_({ContentType.NEW_CHAT_MEMBERS, ContentType.LEFT_CHAT_MEMBER})))
 async def handle_group_message(message: types.Message):
-    logger.info(f"Новое сообщение в группе {message.chat.id} (GROUP_CHAT_ID={GROUP_CHAT_ID}) message_thread_id={getattr(message, 'message_thread_id', None)} text={message.text}")
+    log_event("group_message", logging.DEBUG, chat_id=message.chat.id, thread_id=message.message_thread_id)
     if message.new_chat_members:
         for user in message.new_chat_members:
-            logger.info(f"Добавлен новый участник user_id={user.id} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-            save_user(user)
+            logger.info("Добавлен новый участник user_id=%s (GROUP_CHAT_ID=%s)", user.id, GROUP_CHAT_ID)
+        await save_users(message.new_chat_members)
     if message.left_chat_member:
-        logger.info(f"Пользователь покинул группу user_id={message.left_chat_member.id} (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-        conn = db_connect()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET is_member=0 WHERE user_id=?", (message.left_chat_member.id,))
-        conn.commit()
-        conn.close()
+        logger.info("Пользователь покинул группу user_id=%s (GROUP_CHAT_ID=%s)", message.left_chat_member.id, GROUP_CHAT_ID)
+        await unsubscribe_user(message.left_chat_member.id)
+
+dp.include_routers(commands_router, private_router, callbacks_router, group_router)
+
+# === WEBHOOK ===
+
+class WebhookServer:
+    """Принимает апдейты по HTTP и обрабатывает их конкурентно, не больше max_in_flight одновременно."""
+
+    def __init__(self, secret, max_in_flight):
+        self.secret = secret
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+
+    async def handle(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            logger.warning("Webhook: неверный secret token от %s", request.remote)
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception as e:
+            logger.warning("Webhook: некорректный апдейт: %s", e)
+            return web.Response(status=400)
+        # Если все слоты заняты, ответ задерживается — Telegram сам притормозит доставку
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error("Ошибка обработки апдейта %s: %s", update.update_id, e)
+        finally:
+            self._slots.release()
+
+    async def health(self, request):
+        return web.json_response({"status": "ok", "in_flight": len(self._tasks)})
+
+    async def close(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+async def run_webhook():
+    # Без секрета любой, кто достучится до порта, может подделывать апдейты от имени админов
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_SECRET")
+    server = WebhookServer(WEBHOOK_SECRET, WEBHOOK_MAX_IN_FLIGHT)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, server.handle)
+    app.router.add_get("/healthz", server.health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info("Webhook слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(WEBHOOK_MAX_IN_FLIGHT, 100)
+            )
+            logger.info("Webhook зарегистрирован: %s%s", WEBHOOK_URL.rstrip('/'), WEBHOOK_PATH)
+        # Как и start_polling, завершаемся штатно по SIGINT/SIGTERM, чтобы успели сброситься буферы
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await server.close()
+        await bot.session.close()
 
 async def main():
-    db_init()
-    logger.info(f"Бот запускается... (GROUP_CHAT_ID={GROUP_CHAT_ID})")
-    await dp.start_polling(bot)
+    await db_init()
+    await admin_registry.load()
+    await fsm_storage.load()
+    await followups.load()
+    await closed_incidents.load()
+    response_writer.start()
+    followups.start()
+    background = []
+    background.append(asyncio.create_task(outbox.run()))
+    if METRICS_PORT:
+        background.append(asyncio.create_task(run_metrics_server(METRICS_HOST, METRICS_PORT)))
+    if ADMIN_SYNC_INTERVAL > 0:
+        background.append(asyncio.create_task(admin_registry.watch(ADMIN_SYNC_INTERVAL)))
+        background.append(asyncio.create_task(closed_incidents.watch(ADMIN_SYNC_INTERVAL)))
+    logger.info("Бот запускается... (GROUP_CHAT_ID=%s)", GROUP_CHAT_ID)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await member_sync.close()
+        await followups.close()
+        await callback_gate.close()
+        await response_writer.close()
+        await stats_updater.close()
+        await db.close()
+        logger.info("Бот остановлен.")
 
 if __name__ == "__main__":
     asyncio.run(main())